@@ -1,6 +1,10 @@
 from pathlib import Path
 
-from server.server import app
+from utils import importtime
+
+importtime.install()
+
+from server.server import app  # noqa: E402
 
 __all__ = ["app"]
 
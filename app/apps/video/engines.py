@@ -1,53 +1,179 @@
-import asyncio
-import os
+import functools
+import importlib
+import importlib.metadata
+from types import MappingProxyType
+from typing import Literal, Mapping
 
 from fastapi_mongo_base.utils import basic
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict, StrictBool, TypeAdapter
+from server.config import Settings
 from singleton import Singleton
+from utils import blocking, clients, metrics, ratelimit
 
 
 class VideoTaskSchema(BaseModel):
-    url: str
+    url: str | None = None
     error: str | None = None
     status: str
+    progress: int | None = None
+
+
+class EngineMetaData(BaseModel):
+    # Other keys (webhook, retry_count, ...) stay in meta_data but are not
+    # sent to the provider.
+    model_config = ConfigDict(extra="ignore")
+
+
+class MinimaxMetaData(EngineMetaData):
+    prompt_optimizer: StrictBool = True
+
+
+class KlingMetaData(EngineMetaData):
+    duration: Literal[5, 10] = 5
+    aspect_ratio: Literal["16:9", "9:16", "1:1"] = "16:9"
+
+
+class HunyuanMetaData(EngineMetaData):
+    duration: Literal[5, 10] = 5
+
+
+class RunwayMetaData(EngineMetaData):
+    duration: Literal[5, 10] = 5
+    ratio: Literal["1280:768", "768:1280"] = "1280:768"
+
+
+class LumaMetaData(EngineMetaData):
+    duration: Literal[5, 6, 7, 8, 9] = 5
+    aspect_ratio: Literal["21:9", "9:21", "16:9", "9:16", "3:4", "4:3", "1:1"] = (
+        "16:9"
+    )
+
+
+def normalize_name(name: str) -> str:
+    name = name.lower().replace("engine", "").replace("video", "")
+    return name.replace("-", "").replace("_", "").replace(" ", "")
+
+
+class EngineRegistry:
+    def __init__(self, base: type["AbstractEngine"]):
+        engines: dict[str, AbstractEngine] = {}
+        for subclass in basic.get_all_subclasses(base):
+            if subclass.is_abstract():
+                continue
+            engines.setdefault(subclass.get_class_name(), subclass())
+
+        aliases: dict[str, str] = {}
+        for name, engine in engines.items():
+            for alias in (name, engine.application_name, *engine.aliases):
+                aliases.setdefault(normalize_name(alias), name)
+
+        self.engines: Mapping[str, AbstractEngine] = MappingProxyType(engines)
+        self.aliases: Mapping[str, str] = MappingProxyType(aliases)
+
+    def resolve(self, name: str) -> str | None:
+        return self.aliases.get(normalize_name(name))
+
+    def get(self, name: str) -> "AbstractEngine | None":
+        name = self.resolve(name)
+        if name is None:
+            return None
+        return self.engines[name]
+
+    def __getitem__(self, name: str) -> "AbstractEngine":
+        engine = self.get(name)
+        if engine is None:
+            raise ValueError(f"Engine {name} not found")
+        return engine
+
+
+_registry: EngineRegistry | None = None
+
+
+def load_plugins():
+    # Engines defined elsewhere register by being imported, either listed in
+    # ENGINE_PLUGINS or exposed under the "videogen.engines" entry point group.
+    # Provider SDKs are imported inside engine methods, on first use.
+    for module in Settings.engine_plugins:
+        importlib.import_module(module)
+    for entry_point in importlib.metadata.entry_points(group="videogen.engines"):
+        entry_point.load()
+
+
+def get_registry() -> EngineRegistry:
+    global _registry
+    if _registry is None:
+        load_plugins()
+        _registry = EngineRegistry(AbstractEngine)
+    return _registry
 
 
 class AbstractEngine(metaclass=Singleton):
     application_name: str
     thumbnail_url: str
+    provider: str
     text_to_video: bool = False
     image_to_video: bool = False
+    aliases: tuple[str, ...] = ()
+    # Seconds before a submitted job is likely to be done; the first status
+    # poll is deferred until then.
+    expected_latency: int = 30
+    meta_data_schema: type[EngineMetaData] = EngineMetaData
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        for name in ("generate_async", "get_status", "get_result", "poll"):
+            if name in cls.__dict__:
+                setattr(cls, name, metrics.observe_engine(cls.__dict__[name]))
+
+    @classmethod
+    def is_abstract(cls) -> bool:
+        return cls.__name__.startswith("Abstract")
 
     @classmethod
     def get_class_name(cls) -> str:
         return cls.__name__.lower().replace("engine", "").replace("video", "")
 
     @classmethod
-    def get_subclasses(cls) -> dict[str, "AbstractEngine"]:
-        return {
-            subclass.__name__.lower()
-            .replace("engine", "")
-            .replace("video", ""): subclass()
-            for subclass in basic.get_all_subclasses(cls)
-        }
+    def get_subclasses(cls) -> Mapping[str, "AbstractEngine"]:
+        return get_registry().engines
 
     @classmethod
     def get_subclass(cls, name: str) -> "AbstractEngine":
-        subclasses = cls.get_subclasses()
-        if name.lower().replace("engine", "").replace("video", "") not in subclasses:
-            import logging
+        return get_registry()[name]
 
-            logging.error(f"Subclass with application name {name} not found")
-            name = "runway"
-            # raise ValueError(f"Subclass with application name {name} not found")
-        return subclasses.get(name.lower().replace("engine", "").replace("video", ""))
+    @property
+    def limiter(self) -> ratelimit.RateLimiter:
+        return ratelimit.get_limiter(self.provider)
 
     @property
     def price(self):
         raise NotImplementedError("This method should be implemented by the subclass")
 
-    def validate(self, meta_data: dict) -> tuple[bool, str]:
-        raise NotImplementedError("This method should be implemented by the subclass")
+    @classmethod
+    @functools.cache
+    def meta_data_adapter(cls) -> TypeAdapter[EngineMetaData]:
+        return TypeAdapter(cls.meta_data_schema)
+
+    @classmethod
+    @functools.cache
+    def meta_data_json_schema(cls) -> dict:
+        return cls.meta_data_adapter().json_schema()
+
+    def normalize_meta_data(self, meta_data: dict | None) -> dict:
+        # Validates the declared fields and fills in their defaults; raises
+        # pydantic's ValidationError (a ValueError) on invalid values.
+        meta_data = meta_data or {}
+        declared = self.meta_data_adapter().validate_python(meta_data)
+        return meta_data | declared.model_dump()
+
+    def provider_arguments(self, meta_data: dict | None) -> dict:
+        # Declared fields only; meta_data was normalized when the video was
+        # created, the defaults cover videos stored before that.
+        meta_data = meta_data or {}
+        return {
+            name: meta_data.get(name, field.default)
+            for name, field in self.meta_data_schema.model_fields.items()
+        }
 
     async def generate_async(
         self,
@@ -66,6 +192,11 @@ class AbstractEngine(metaclass=Singleton):
     async def get_result(self, request_id: str) -> VideoTaskSchema:
         raise NotImplementedError("This method should be implemented by the subclass")
 
+    async def poll(self, request_id: str) -> VideoTaskSchema:
+        # A single snapshot of status, progress, result and error, fetched with
+        # as few provider calls as the provider allows.
+        raise NotImplementedError("This method should be implemented by the subclass")
+
 
 class AbstractImageToVideoEngine(AbstractEngine):
     application_name: str
@@ -82,6 +213,8 @@ class AbstractTextToVideoEngine(AbstractEngine):
 
 
 class AbstractFalEngine(AbstractEngine):
+    provider = "fal"
+
     @property
     def price(self):
         return 75
@@ -97,62 +230,52 @@ class AbstractFalEngine(AbstractEngine):
     ):
         import fal_client
 
-        meta_data = meta_data or {}
-        self.validate(meta_data)
-
-        data = (
-            {
-                "prompt": prompt,
-                **meta_data,
-            }
-            | {"image_url": image_url}
-            if image_url
-            else {}
-        )
-        handler = await fal_client.submit_async(
-            self.application_name,
-            webhook_url=webhook_url,
-            arguments=data,
-        )
+        data = {"prompt": prompt, **self.provider_arguments(meta_data)}
+        if image_url:
+            data["image_url"] = image_url
+        async with self.limiter:
+            handler = await fal_client.submit_async(
+                self.application_name,
+                webhook_url=webhook_url,
+                arguments=data,
+            )
         return handler.request_id
 
     async def get_status(self, request_id: str):
         import fal_client
 
-        status = await fal_client.status_async(
-            self.application_name, request_id, with_logs=True
-        )
+        async with self.limiter:
+            status = await fal_client.status_async(
+                self.application_name, request_id, with_logs=True
+            )
         return status.__class__.__name__.lower()
 
     async def get_result(self, request_id: str):
         import fal_client
 
-        result, status = await asyncio.gather(
-            fal_client.result_async(self.application_name, request_id),
-            self.get_status(request_id),
-        )
-
+        async with self.limiter:
+            result = await fal_client.result_async(self.application_name, request_id)
         url = result.get("video", {}).get("url")
         error = result.get("error")
-        return VideoTaskSchema(url=url, error=error, status=status)
+        # fal only serves results for completed requests.
+        return VideoTaskSchema(url=url, error=error, status="completed")
+
+    async def poll(self, request_id: str):
+        status = await self.get_status(request_id)
+        if status != "completed":
+            return VideoTaskSchema(status=status)
+        return await self.get_result(request_id)
 
 
 class AbstractMinimaxEngine(AbstractFalEngine):
     thumbnail_url = "https://media.pixiee.io/v1/f/8f1e0257-e2ad-454d-b81c-9d09a6aa7916/hailuo-icon.png"
+    expected_latency = 90
+    meta_data_schema = MinimaxMetaData
 
     @property
     def price(self):
         return 150
 
-    def validate(self, meta_data: dict):
-        prompt_optimizer = meta_data.get("prompt_optimizer", True)
-        prompt_optimizer_valid = isinstance(prompt_optimizer, bool)
-        if not prompt_optimizer_valid:
-            message = "prompt_optimizer must be boolean"
-        else:
-            message = None
-        return prompt_optimizer_valid, message
-
 
 class HailouEngine(AbstractMinimaxEngine, AbstractImageToVideoEngine):
     application_name = "fal-ai/minimax/video-01/image-to-video"
@@ -168,24 +291,13 @@ class HailouTextEngine(AbstractMinimaxEngine, AbstractTextToVideoEngine):
 
 class AbstractKlingEngine(AbstractFalEngine):
     thumbnail_url = "https://media.pixiee.io/v1/f/abe6c5ae-3d88-4d67-a5a8-d421042522a4/kling-video-icon.png"
+    expected_latency = 10
+    meta_data_schema = KlingMetaData
 
     @property
     def price(self):
         return 45
 
-    def validate(self, meta_data: dict):
-        duration = meta_data.get("duration", 5)
-        aspect_ratio = meta_data.get("aspect_ratio", "16:9")
-        duration_valid = duration in {5, 10}
-        aspect_ratio_valid = aspect_ratio in {"16:9", "9:16", "1:1"}
-        if not duration_valid:
-            message = "Duration must be 5 or 10"
-        elif not aspect_ratio_valid:
-            message = "aspect_ratio must be 16:9 or 9:16 or 1:1"
-        else:
-            message = None
-        return duration_valid and aspect_ratio_valid, message
-
 
 class KlingTextVideoEngine(AbstractKlingEngine, AbstractTextToVideoEngine):
     application_name = "fal-ai/kling-video/v1/standard/text-to-video"
@@ -222,15 +334,8 @@ class KlingProVideoEngine(AbstractKlingEngine, AbstractTextToVideoEngine):
 class HunyuanEngine(AbstractFalEngine, AbstractTextToVideoEngine):
     application_name = "fal-ai/hunyuan-video"
     thumbnail_url = "https://media.pixiee.io/v1/f/bdefc333-f9d6-4d48-9f88-62230baa72a6/runway-icon.png"
-
-    def validate(self, meta_data: dict):
-        duration = meta_data.get("duration", 5)
-        duration_valid = duration in {5, 10}
-        if not duration_valid:
-            message = "Duration must be 5 or 10"
-        else:
-            message = None
-        return duration_valid, message
+    expected_latency = 60
+    meta_data_schema = HunyuanMetaData
 
     @property
     def price(self):
@@ -240,6 +345,7 @@ class HunyuanEngine(AbstractFalEngine, AbstractTextToVideoEngine):
 class HunyuanImageToVideoEngine(AbstractFalEngine, AbstractImageToVideoEngine):
     application_name = "fal-ai/hunyuan-video-img2vid-lora"
     thumbnail_url = "https://media.pixiee.io/v1/f/bdefc333-f9d6-4d48-9f88-62230baa72a6/runway-icon.png"
+    expected_latency = 60
 
     @property
     def price(self):
@@ -248,27 +354,16 @@ class HunyuanImageToVideoEngine(AbstractFalEngine, AbstractImageToVideoEngine):
 
 class RunwayEngine(AbstractImageToVideoEngine):
     application_name = "runway-gen3"
+    provider = "runway"
     thumbnail_url = "https://media.pixiee.io/v1/f/bdefc333-f9d6-4d48-9f88-62230baa72a6/runway-icon.png"
     text_to_video: bool = False
     image_to_video: bool = True
+    meta_data_schema = RunwayMetaData
 
     @property
     def price(self):
         return 75
 
-    def validate(self, meta_data: dict):
-        duration = meta_data.get("duration", 5)
-        ratio = meta_data.get("ratio", "1280:768")
-        duration_valid = duration in {5, 10}
-        ratio_valid = ratio in {"1280:768", "768:1280"}
-        if not duration_valid:
-            message = "Duration must be 5 or 10"
-        elif not ratio_valid:
-            message = "Ratio must be 1280:768 or 768:1280"
-        else:
-            message = None
-        return duration_valid and ratio_valid, message
-
     async def generate_async(
         self,
         prompt: str,
@@ -278,44 +373,45 @@ class RunwayEngine(AbstractImageToVideoEngine):
         webhook_url: str = None,
         **kwargs,
     ):
-        from runwayml import AsyncRunwayML
-
-        meta_data = meta_data or {}
-
-        self.validate(meta_data)
-
-        async with AsyncRunwayML(api_key=os.getenv("RUNWAY_API_KEY")) as runway:
-            task = await runway.image_to_video.create(
+        arguments = self.provider_arguments(meta_data)
+        async with self.limiter:
+            task = await clients.get_runway_client().image_to_video.create(
                 model="gen3a_turbo",
                 prompt_text=prompt,
                 prompt_image=image_url,
-                duration=meta_data.get("duration", 5),
-                ratio=meta_data.get("ratio", "1280:768"),
+                **arguments,
             )
-
         return task.id
 
     async def _get_task(self, request_id: str):
-        from runwayml import AsyncRunwayML
-
-        async with AsyncRunwayML(api_key=os.getenv("RUNWAY_API_KEY")) as runway:
-            task = await runway.tasks.retrieve(request_id)
-        return task
+        async with self.limiter:
+            return await clients.get_runway_client().tasks.retrieve(request_id)
 
     async def get_status(self, request_id: str):
         task = await self._get_task(request_id)
         return task.status
 
     async def get_result(self, request_id: str):
+        return await self.poll(request_id)
+
+    async def poll(self, request_id: str):
         task = await self._get_task(request_id)
         if task.output:
             url = task.output[0]
         else:
             url = None
-        return VideoTaskSchema(url=url, error=task.failure, status=task.status)
+        progress = getattr(task, "progress", None)
+        return VideoTaskSchema(
+            url=url,
+            error=task.failure,
+            status=task.status,
+            progress=int(progress * 100) if progress is not None else None,
+        )
 
 
 class AbstractReplicateEngine(AbstractEngine):
+    provider = "replicate"
+
     @property
     def price(self):
         return 75
@@ -331,76 +427,49 @@ class AbstractReplicateEngine(AbstractEngine):
     ):
         import replicate
 
-        meta_data = meta_data or {}
-        self.validate(meta_data)
-
-        data = (
-            {
-                "prompt": prompt,
-                **meta_data,
-            }
-            | {"start_image_url": image_url}
-            if image_url
-            else {}
-        )
-        handler = replicate.predictions.create(
-            model=self.application_name,
-            input=data,
-            webhook=webhook_url,
-        )
+        data = {"prompt": prompt, **self.provider_arguments(meta_data)}
+        if image_url:
+            data["start_image_url"] = image_url
+        async with self.limiter:
+            # The SDK's create is synchronous.
+            handler = await blocking.run_blocking(
+                replicate.predictions.create,
+                model=self.application_name,
+                input=data,
+                webhook=webhook_url,
+            )
         return handler.id
 
     async def get_status(self, request_id: str):
-        import replicate
-
-        status = await replicate.predictions.async_get(request_id)
-        return status.status
+        return (await self.poll(request_id)).status
 
     async def get_result(self, request_id: str):
-        import replicate
-
-        result, status = await replicate.predictions.async_get(request_id)
-
-        url = result.get("video", {}).get("url")
-        error = result.get("error")
-        return VideoTaskSchema(url=url, error=error, status=status)
+        return await self.poll(request_id)
 
+    async def poll(self, request_id: str):
+        import replicate
 
-class LumaEngine(AbstractReplicateEngine, AbstractTextToVideoEngine):
-    application_name = "luma/ray-2-720p"
-
-    @property
-    def price(self):
-        return 240
+        async with self.limiter:
+            prediction = await replicate.predictions.async_get(request_id)
+        output = prediction.output
+        if isinstance(output, list):
+            output = output[0] if output else None
+        error = prediction.error
+        return VideoTaskSchema(
+            url=output if isinstance(output, str) else None,
+            error=str(error) if error else None,
+            status=prediction.status,
+        )
 
 
 class LumaEngine(AbstractReplicateEngine, AbstractTextToVideoEngine):
     application_name = "luma/ray-2-720p"
+    expected_latency = 240
+    meta_data_schema = LumaMetaData
     thumbnail_url = (
         "https://media.pixiee.io/v1/f/4701330c-aa98-4d86-91d4-982ff94d30f3/photon.png"
     )
 
-    def validate(self, meta_data: dict):
-        duration = meta_data.get("duration", 5)
-        duration_valid = duration in {5, 6, 7, 8, 9}
-        aspect_ratio = meta_data.get("aspect_ratio", "16:9")
-        aspect_ratio_valid = aspect_ratio in {
-            "21:9",
-            "9:21",
-            "16:9",
-            "9:16",
-            "3:4",
-            "4:3",
-            "1:1",
-        }
-        if not duration_valid:
-            message = "Duration must be 5, 6, 7, 8, 9"
-        elif not aspect_ratio_valid:
-            message = "Aspect ratio must be 21:9, 9:21, 16:9, 9:16, 3:4, 4:3 or 1:1"
-        else:
-            message = None
-        return duration_valid and aspect_ratio_valid, message
-
     @property
     def price(self):
         return 240
@@ -1,46 +1,631 @@
-import asyncio
+import logging
+import random
+import uuid
+from datetime import datetime, timedelta
 
-from fastapi_mongo_base.models import OwnedEntity
+from beanie import (
+    Insert,
+    PydanticObjectId,
+    Replace,
+    Save,
+    SaveChanges,
+    UpdateResponse,
+    after_event,
+)
+from fastapi_mongo_base.models import BaseEntity, OwnedEntity
+from fastapi_mongo_base.tasks import TaskStatusEnum
+from fastapi_mongo_base.utils import basic
+from pydantic import BaseModel, Field
+from pymongo import ASCENDING, DESCENDING, IndexModel
+from pymongo.errors import DuplicateKeyError
+from server import config
+from utils import metrics
 
-from .schemas import VideoSchema
+from . import engines
+from .schemas import VideoListItemSchema, VideoSchema, VideoStatus, VideoWebhookData
+
+
+def lease_deadline() -> datetime:
+    # Mongo keeps milliseconds only; truncate so the value round-trips exactly.
+    deadline = datetime.now() + timedelta(seconds=config.Settings.lease_duration)
+    return deadline.replace(microsecond=deadline.microsecond // 1000 * 1000)
 
 
 class Video(VideoSchema, OwnedEntity):
+    next_poll_at: datetime | None = None
+    lease_owner: str | None = None
+    lease_until: datetime | None = None
+    retry_at: datetime | None = None
+    # Status and engine this video is counted under in VideoStatsRollup.
+    rollup_status: VideoStatus | None = None
+    rollup_engine: str | None = None
+    request_hash: str | None = None
+    # Submitted video whose result this one is waiting for.
+    reuse_of: uuid.UUID | None = None
+
     class Settings:
-        indexes = OwnedEntity.Settings.indexes
+        indexes = OwnedEntity.Settings.indexes + [
+            # Poll loop; only submitted jobs are indexed.
+            IndexModel(
+                [
+                    ("status", ASCENDING),
+                    ("next_poll_at", ASCENDING),
+                    ("lease_until", ASCENDING),
+                ],
+                name="worker_poll",
+                partialFilterExpression={"request_id": {"$type": "string"}},
+            ),
+            # Null fields are stored, so sparse indexes would cover every
+            # video; queries repeat these filters to use the indexes.
+            IndexModel(
+                [("retry_at", ASCENDING)],
+                name="retry_at_due",
+                partialFilterExpression={"retry_at": {"$type": "date"}},
+            ),
+            IndexModel(
+                [("request_hash", ASCENDING), ("created_at", DESCENDING)],
+                name="request_hash",
+                partialFilterExpression={"request_hash": {"$type": "string"}},
+            ),
+            IndexModel(
+                [("reuse_of", ASCENDING)],
+                name="reuse_of_attached",
+                partialFilterExpression={"reuse_of": {"$type": "binData"}},
+            ),
+            # In-flight counts of the metrics endpoint.
+            IndexModel(
+                [("status", ASCENDING), ("is_deleted", ASCENDING)],
+                name="status",
+            ),
+            # Listing, statistics and active-video streams of a user.
+            IndexModel(
+                [
+                    ("user_id", ASCENDING),
+                    ("status", ASCENDING),
+                    ("created_at", DESCENDING),
+                ],
+                name="user_status_created",
+            ),
+            IndexModel(
+                [("user_id", ASCENDING), ("created_at", DESCENDING)],
+                name="user_created",
+            ),
+        ]
+
+    @classmethod
+    def due_query(cls, since: datetime) -> dict:
+        return cls._claim_query(
+            {
+                # Matches the worker_poll partial index filter.
+                "request_id": {"$type": "string"},
+                # Also matches videos submitted before polls were scheduled.
+                "next_poll_at": {"$not": {"$gt": datetime.now()}},
+            },
+            since,
+        )
+
+    @classmethod
+    def due_retries_query(cls, since: datetime) -> dict:
+        return cls._claim_query(
+            {"retry_at": {"$type": "date", "$lte": datetime.now()}}, since
+        )
+
+    @classmethod
+    def in_flight_query(cls) -> dict:
+        statuses = [
+            status.value
+            for status in VideoStatus
+            if not status.is_done
+            and status not in (VideoStatus.none, VideoStatus.draft)
+        ]
+        return {"status": {"$in": statuses}, "is_deleted": False}
+
+    @classmethod
+    def _claim_query(cls, query: dict, since: datetime) -> dict:
+        # Leases released after `since` are skipped, so a cycle never claims
+        # the same video twice.
+        return {
+            "is_deleted": False,
+            "status": {"$nin": VideoStatus.done_statuses()},
+            "lease_until": {"$not": {"$gte": since}},
+            **query,
+        }
+
+    @classmethod
+    async def claim_due(cls, limit: int, since: datetime) -> list["VideoPoll"]:
+        return await cls._claim_many(cls.due_query(since), limit, VideoPoll)
+
+    @classmethod
+    async def claim_due_retries(cls, limit: int, since: datetime) -> list["Video"]:
+        return await cls._claim_many(cls.due_retries_query(since), limit)
+
+    @classmethod
+    async def _claim_many(cls, query: dict, limit: int, projection=None) -> list:
+        collection = cls.get_motor_collection()
+        ids = [
+            doc["_id"]
+            async for doc in collection.find(query, {"_id": 1}).limit(limit)
+        ]
+        if not ids:
+            return []
+
+        lease_until = lease_deadline()
+        lease = {"lease_owner": config.Settings.worker_id, "lease_until": lease_until}
+        await collection.update_many(
+            {"_id": {"$in": ids}, **query},
+            {"$set": lease},
+        )
+        return await cls.find(
+            {"_id": {"$in": ids}, **lease}, projection_model=projection
+        ).to_list()
+
+    @classmethod
+    async def claim(cls, uid: uuid.UUID) -> "Video | None":
+        return await cls.find_one(
+            {"uid": uid, "lease_until": {"$not": {"$gte": datetime.now()}}}
+        ).update(
+            {
+                "$set": {
+                    "lease_owner": config.Settings.worker_id,
+                    "lease_until": lease_deadline(),
+                }
+            },
+            response_type=UpdateResponse.NEW_DOCUMENT,
+        )
+
+    async def release_lease(self):
+        self.lease_owner = None
+        self.lease_until = await release_lease(self.id)
 
     async def start_processing(self):
         from apps.video.services import video_request
 
         await video_request(self)
 
-    async def retry(self, message: str, max_retries: int = 5):
+    async def retry(
+        self, message: str, max_retries: int = 5, *, retryable: bool = True
+    ):
         self.meta_data = self.meta_data or {}
         retry_count = self.meta_data.get("retry_count", 0)
 
-        if retry_count < max_retries:
+        if retryable and retry_count < max_retries:
+            # Exponential backoff with equal jitter, so a provider incident does
+            # not turn into synchronized resubmissions.
+            delay = min(
+                config.Settings.retry_base_delay * 2**retry_count,
+                config.Settings.retry_max_delay,
+            )
+            delay = delay / 2 + random.uniform(0, delay / 2)
             self.meta_data["retry_count"] = retry_count + 1
-            await self.save_report(
-                f"Retry {self.uid} {self.meta_data.get('retry_count')}", emit=False
+            metrics.RETRIES.labels("retry").inc()
+            await self.requeue(
+                f"Retry {self.uid} {self.meta_data.get('retry_count')} "
+                f"in {delay:.0f}s: {message}",
+                delay,
             )
-            await self.save_and_emit()
-            asyncio.create_task(self.start_processing())
             return retry_count + 1
 
         await self.fail(message)
         return -1
 
-    async def fail(self, message: str):
-        from utils import finance
+    async def requeue(self, message: str, delay: float):
+        # Schedules a resubmission without spending the retry budget.
+        self.retry_at = datetime.now() + timedelta(seconds=delay)
+        self.request_id = None
+        self.status = VideoStatus.init
+        self.task_status = VideoStatus.init.task_status
+        await self.save_report(message, emit=False)
+        await self.save_and_emit()
 
+    async def fail(self, message: str):
         self.task_status = "error"
         self.status = "error"
+        self.retry_at = None
         await self.save_report(f"Image failed after retries, {message}", emit=False)
         await self.save_and_emit()
-        await finance.cancel_usage(self.usage_id)
+        await self.refund()
+        # Videos waiting for this one are submitted on their own.
+        await Video.find(
+            {
+                "reuse_of": {"$type": "binData", "$eq": self.uid},
+                "status": {"$nin": VideoStatus.done_statuses()},
+            }
+        ).update_many({"$set": {"retry_at": datetime.now()}})
+
+    async def refund(self):
+        from utils import finance
+
+        if await finance.release_reservation(self.uid):
+            return
+        # Videos created before reservations were charged up front.
+        if self.usage_id is None:
+            return
+        try:
+            await finance.cancel_usage(self.usage_id)
+        except Exception as e:
+            logging.error(f"Refunding usage {self.usage_id} of {self.uid} failed: {e}")
+
+    def rollup_values(self, status: VideoStatus, engine_name: str) -> dict:
+        engine = engines.get_registry().get(engine_name)
+        values = {"videos": 1, "coins": engine.price if engine else 0}
+        if status == VideoStatus.completed and self.task_end_at:
+            values["completion_seconds"] = (
+                self.task_end_at - self.created_at
+            ).total_seconds()
+        return values
+
+    @after_event([Insert, Replace, Save, SaveChanges])
+    @basic.try_except_wrapper
+    async def sync_rollup(self):
+        # Deleted videos are taken out of the rollups.
+        status = None if self.is_deleted else VideoStatus(self.status)
+        engine = None if self.is_deleted else self.engine
+        previous = self.rollup_status
+        # Videos counted before the engine was recorded keep their engine.
+        previous_engine = (self.rollup_engine or self.engine) if previous else None
+        if (status, engine) == (previous, previous_engine):
+            return
+        # Conditional on the previous values, so concurrent saves of the same
+        # transition are counted once.
+        claimed = await self.get_motor_collection().update_one(
+            {
+                "_id": self.id,
+                "rollup_status": previous.value if previous else None,
+                "rollup_engine": self.rollup_engine,
+            },
+            {
+                "$set": {
+                    "rollup_status": status.value if status else None,
+                    "rollup_engine": engine,
+                }
+            },
+        )
+        if not claimed.modified_count:
+            return
+        self.rollup_status = status
+        self.rollup_engine = engine
+        if previous is not None:
+            # Rerouted videos are taken out of the row of their old engine.
+            await VideoStatsRollup.add(self, previous_engine, previous, -1)
+        if status is not None:
+            await VideoStatsRollup.add(self, engine, status, 1)
 
     @classmethod
     async def get_item(cls, uid, user_id, *args, **kwargs) -> "Video":
         return await super(OwnedEntity, cls).get_item(
             uid, user_id=user_id, *args, **kwargs
         )
+
+    @classmethod
+    async def list_items(
+        cls,
+        user_id: uuid.UUID = None,
+        business_name: str = None,
+        offset: int = 0,
+        limit: int = 10,
+        is_deleted: bool = False,
+        *args,
+        **kwargs,
+    ) -> list[VideoListItemSchema]:
+        offset, limit = cls.adjust_pagination(offset, limit)
+        query = cls.get_query(
+            user_id=user_id,
+            business_name=business_name,
+            is_deleted=is_deleted,
+            *args,
+            **kwargs,
+        )
+        return await (
+            query.sort("-created_at")
+            .skip(offset)
+            .limit(limit)
+            .project(VideoListItemSchema)
+            .to_list()
+        )
+
+
+async def release_lease(video_id: PydanticObjectId) -> datetime:
+    released_at = datetime.now()
+    await Video.get_motor_collection().update_one(
+        {"_id": video_id, "lease_owner": config.Settings.worker_id},
+        {"$set": {"lease_owner": None, "lease_until": released_at}},
+    )
+    return released_at
+
+
+class VideoPoll(BaseModel):
+    # What a status poll reads. The document is loaded in full only when the
+    # status changes, so task logs and results are not transferred per poll.
+    id: PydanticObjectId = Field(alias="_id")
+    uid: uuid.UUID
+    user_id: uuid.UUID
+    engine: str
+    request_id: str | None = None
+    status: VideoStatus
+    task_status: TaskStatusEnum = TaskStatusEnum.draft
+    task_progress: int = -1
+    task_start_at: datetime | None = None
+    next_poll_at: datetime | None = None
+
+    @property
+    def engine_instance(self):
+        return engines.get_registry().get(self.engine)
+
+    async def hydrate(self) -> Video | None:
+        return await Video.get(self.id)
+
+    async def set_fields(self, **values):
+        for field, value in values.items():
+            setattr(self, field, value)
+        await Video.get_motor_collection().update_one(
+            {"_id": self.id}, {"$set": {**values, "updated_at": datetime.now()}}
+        )
+
+    async def release_lease(self):
+        await release_lease(self.id)
+
+
+class VideoStatsRollup(BaseEntity):
+    hour: datetime
+    engine: str
+    status: VideoStatus
+    user_id: uuid.UUID
+    videos: int = 0
+    coins: float = 0
+    completion_seconds: float = 0
+
+    class Settings:
+        indexes = BaseEntity.Settings.indexes + [
+            IndexModel(
+                [
+                    ("hour", ASCENDING),
+                    ("engine", ASCENDING),
+                    ("status", ASCENDING),
+                    ("user_id", ASCENDING),
+                ],
+                unique=True,
+                name="rollup_key",
+            ),
+        ]
+
+    @classmethod
+    async def add(cls, video: Video, engine: str, status: VideoStatus, sign: int):
+        # Videos are bucketed by the hour they were created in.
+        key = {
+            "hour": video.created_at.replace(minute=0, second=0, microsecond=0),
+            "engine": engine,
+            "status": status,
+            "user_id": video.user_id,
+        }
+        values = {
+            field: sign * value
+            for field, value in video.rollup_values(status, engine).items()
+        }
+        for _ in range(2):
+            try:
+                await cls.find_one(key).upsert(
+                    {"$inc": values}, on_insert=cls(**key, **values)
+                )
+                return
+            except DuplicateKeyError:
+                # Another writer created the row first; increment it instead.
+                continue
+
+    @classmethod
+    async def summary(
+        cls,
+        created_at_from: datetime | None = None,
+        created_at_to: datetime | None = None,
+        status: VideoStatus | None = None,
+    ) -> dict:
+        query = {"is_deleted": False}
+        hour = {}
+        if created_at_from:
+            hour["$gte"] = created_at_from.replace(minute=0, second=0, microsecond=0)
+        if created_at_to:
+            hour["$lte"] = created_at_to
+        if hour:
+            query["hour"] = hour
+        if status:
+            query["status"] = status
+
+        rows = await cls.find(query).aggregate(
+            [
+                {
+                    "$group": {
+                        "_id": {"engine": "$engine", "status": "$status"},
+                        "videos": {"$sum": "$videos"},
+                        "coins": {"$sum": "$coins"},
+                        "completion_seconds": {"$sum": "$completion_seconds"},
+                    }
+                }
+            ]
+        ).to_list()
+
+        result = {
+            "total": 0,
+            "completed": 0,
+            "failed": 0,
+            "coins": 0,
+            "avg_completion_seconds": None,
+            "by_status": {},
+            "by_engine": {},
+        }
+        completion_seconds = 0
+        for row in rows:
+            engine, row_status = row["_id"]["engine"], row["_id"]["status"]
+            result["total"] += row["videos"]
+            result["coins"] += row["coins"]
+            result["by_status"][row_status] = (
+                result["by_status"].get(row_status, 0) + row["videos"]
+            )
+            by_engine = result["by_engine"].setdefault(
+                engine, {"total": 0, "completed": 0, "failed": 0, "coins": 0}
+            )
+            by_engine["total"] += row["videos"]
+            by_engine["coins"] += row["coins"]
+            if row_status == VideoStatus.completed:
+                result["completed"] += row["videos"]
+                by_engine["completed"] += row["videos"]
+                completion_seconds += row["completion_seconds"]
+            elif row_status == VideoStatus.error:
+                result["failed"] += row["videos"]
+                by_engine["failed"] += row["videos"]
+        if result["completed"]:
+            result["avg_completion_seconds"] = completion_seconds / result["completed"]
+        return result
+
+
+class DataMigration(BaseEntity):
+    # One-off data migrations that have completed.
+    name: str
+
+    class Settings:
+        indexes = BaseEntity.Settings.indexes + [
+            IndexModel([("name", ASCENDING)], unique=True),
+        ]
+
+    @classmethod
+    async def done(cls, name: str) -> bool:
+        return await cls.find_one({"name": name}) is not None
+
+    @classmethod
+    async def mark_done(cls, name: str):
+        try:
+            await cls(name=name).insert()
+        except DuplicateKeyError:
+            # Another replica finished it as well.
+            pass
+
+
+async def backfill_rollups():
+    # Counts videos saved before rollups existed; later saves keep them
+    # current. The lookup has no index, so it runs to completion only once.
+    if await DataMigration.done("backfill_rollups"):
+        return
+    query = {"rollup_status": None, "is_deleted": False}
+    while videos := await Video.find(query).sort("_id").limit(
+        config.Settings.update_batch_size
+    ).to_list():
+        for video in videos:
+            await video.sync_rollup()
+        query = {
+            "rollup_status": None,
+            "is_deleted": False,
+            "_id": {"$gt": videos[-1].id},
+        }
+    await DataMigration.mark_done("backfill_rollups")
+
+
+class VideoWebhookEvent(BaseEntity):
+    key: str
+    video_uid: uuid.UUID
+    request_id: str | None = None
+    data: dict
+    attempts: int = 0
+    lease_until: datetime | None = None
+    processed_at: datetime | None = None
+
+    class Settings:
+        indexes = BaseEntity.Settings.indexes + [
+            IndexModel([("key", ASCENDING)], unique=True),
+            IndexModel([("processed_at", ASCENDING), ("lease_until", ASCENDING)]),
+            IndexModel(
+                [("created_at", ASCENDING)],
+                expireAfterSeconds=config.Settings.webhook_event_ttl,
+            ),
+        ]
+
+    @property
+    def webhook_data(self) -> VideoWebhookData:
+        return VideoWebhookData(**self.data)
+
+    @classmethod
+    async def ingest(
+        cls, video: Video, request_id: str, data: VideoWebhookData
+    ) -> "VideoWebhookEvent | None":
+        # Providers redeliver webhooks; one event per (job, status) is kept.
+        event = cls(
+            key=f"{video.uid}:{request_id}:{data.status.value}",
+            video_uid=video.uid,
+            request_id=request_id,
+            data=data.model_dump(mode="json"),
+        )
+        try:
+            await event.insert()
+        except DuplicateKeyError:
+            return None
+        return event
+
+    @classmethod
+    def pending_query(cls) -> dict:
+        return {
+            "processed_at": None,
+            "lease_until": {"$not": {"$gte": datetime.now()}},
+        }
+
+    @classmethod
+    async def claim_next(cls) -> "VideoWebhookEvent | None":
+        return await cls.find_one(cls.pending_query()).update(
+            {"$set": {"lease_until": lease_deadline()}, "$inc": {"attempts": 1}},
+            response_type=UpdateResponse.NEW_DOCUMENT,
+        )
+
+    async def mark_processed(self):
+        self.processed_at = datetime.now()
+        await self.get_motor_collection().update_one(
+            {"_id": self.id}, {"$set": {"processed_at": self.processed_at}}
+        )
+
+    async def postpone(self, seconds: float):
+        self.lease_until = datetime.now() + timedelta(seconds=seconds)
+        await self.get_motor_collection().update_one(
+            {"_id": self.id}, {"$set": {"lease_until": self.lease_until}}
+        )
+
+
+async def sync_indexes():
+    # Beanie creates declared indexes on startup but never drops the ones
+    # that were removed from the declarations.
+    if not config.Settings.drop_stale_indexes:
+        return
+    for model in (Video, VideoWebhookEvent):
+        declared = {index.document["name"] for index in model.Settings.indexes}
+        collection = model.get_motor_collection()
+        for name in await collection.index_information():
+            if name == "_id_" or name in declared:
+                continue
+            logging.warning(f"Dropping stale index {model.__name__}.{name}")
+            await collection.drop_index(name)
+
+
+def plan_stages(plan: dict):
+    yield plan.get("stage")
+    for child in [plan.get("inputStage"), *plan.get("inputStages", [])]:
+        if child:
+            yield from plan_stages(child)
+
+
+async def query_plans() -> dict[str, list[str]]:
+    # Winning plan stages of the hot worker queries.
+    since = datetime.now()
+    queries = {
+        "poll": (Video, Video.due_query(since)),
+        "retry": (Video, Video.due_retries_query(since)),
+        "webhook": (VideoWebhookEvent, VideoWebhookEvent.pending_query()),
+        "in_flight": (Video, Video.in_flight_query()),
+    }
+    plans = {}
+    for name, (model, query) in queries.items():
+        explain = await model.get_motor_collection().find(query).limit(1).explain()
+        plans[name] = list(plan_stages(explain["queryPlanner"]["winningPlan"]))
+    return plans
+
+
+async def check_query_plans():
+    # Warns when a hot worker query would scan the whole collection.
+    for name, stages in (await query_plans()).items():
+        if "COLLSCAN" in stages:
+            logging.warning(f"{name} query is a collection scan: {stages}")
+        else:
+            logging.info(f"{name} query plan: {stages}")
@@ -1,20 +1,32 @@
+import asyncio
+import functools
+import json
 import logging
 import uuid
 from datetime import datetime
-from apps.video.models import Video
+from apps.video import routing
+from apps.video.engines import get_registry
+from apps.video.models import Video, VideoStatsRollup, VideoWebhookEvent
 from apps.video.schemas import (
+    VideoBulkCreateResult,
     VideoCreateSchema,
     VideoEnginesSchema,
+    VideoListItemSchema,
     VideoSchema,
     VideoWebhookData,
     VideoStatus,
 )
-from apps.video.services import process_video_webhook, register_cost
-from fastapi import BackgroundTasks, Request, Query
+from apps.video.services import progress_event, register_cost, start_processing_many
+from apps.video.worker import notify_webhook_event
+from fastapi import BackgroundTasks, Body, Query, Request, Response
+from fastapi.responses import StreamingResponse
+from fastapi_mongo_base.core.exceptions import BaseHTTPException
 from fastapi_mongo_base.routes import AbstractTaskRouter
+from fastapi_mongo_base.schemas import PaginatedResponse
+from pydantic import ValidationError
 from usso.fastapi import jwt_access_security
-from utils import finance
 from server.config import Settings
+from utils import finance, pubsub
 
 
 class VideoRouter(AbstractTaskRouter[Video, VideoSchema]):
@@ -27,6 +39,15 @@ class VideoRouter(AbstractTaskRouter[Video, VideoSchema]):
             # prefix="",
         )
 
+    def config_schemas(self, schema, **kwargs):
+        # Listings are projected, so they are served without the task logs.
+        super().config_schemas(
+            schema,
+            list_item_schema=VideoListItemSchema,
+            list_response_schema=PaginatedResponse[VideoListItemSchema],
+            **kwargs,
+        )
+
     def config_routes(self, **kwargs):
         super().config_routes(update_routes=False, **kwargs)
         self.router.add_api_route(
@@ -35,6 +56,25 @@ class VideoRouter(AbstractTaskRouter[Video, VideoSchema]):
             methods=["POST"],
             status_code=200,
         )
+        self.router.add_api_route(
+            "/bulk",
+            self.create_items,
+            methods=["POST"],
+            response_model=list[VideoBulkCreateResult],
+            status_code=201,
+        )
+        self.router.add_api_route(
+            "/stream",
+            self.stream_items,
+            methods=["GET"],
+            response_class=StreamingResponse,
+        )
+        self.router.add_api_route(
+            "/{uid:uuid}/stream",
+            self.stream_item,
+            methods=["GET"],
+            response_class=StreamingResponse,
+        )
 
     async def statistics(
         self,
@@ -43,7 +83,11 @@ class VideoRouter(AbstractTaskRouter[Video, VideoSchema]):
         created_at_to: datetime | None = None,
         status: VideoStatus | None = None,
     ):
-        return await super().statistics(request)
+        # Hourly rollups; created_at_from is rounded down to the hour.
+        return {
+            **await VideoStatsRollup.summary(created_at_from, created_at_to, status),
+            **request.query_params,
+        }
 
     async def create_item(
         self,
@@ -51,36 +95,186 @@ class VideoRouter(AbstractTaskRouter[Video, VideoSchema]):
         data: VideoCreateSchema,
         background_tasks: BackgroundTasks,
     ):
-        item: Video = await super(AbstractTaskRouter, self).create_item(request, data)
-        await finance.check_quota(item.user_id, item.engine_instance.price)
+        # Built from the validated request, so routing and metadata
+        # normalization are not repeated.
+        item = Video(
+            **data.model_dump(),
+            user_id=await self.get_user_id(request),
+            status=VideoStatus.init,
+            task_status="init",
+        )
         await register_cost(item)
-        item.status = VideoStatus.init
-        item.task_status = "init"
-        await item.save()
+        try:
+            await item.insert()
+        except Exception:
+            await finance.release_reservation(item.uid)
+            raise
         background_tasks.add_task(item.start_processing)
         return item
 
-    async def webhook(self, request: Request, uid: uuid.UUID, data: VideoWebhookData):
+    async def create_items(
+        self,
+        request: Request,
+        background_tasks: BackgroundTasks,
+        data: list[dict] = Body(...),
+    ):
+        if len(data) > Settings.bulk_max_items:
+            raise BaseHTTPException(
+                status_code=400,
+                error="too_many_items",
+                message=f"At most {Settings.bulk_max_items} videos per request.",
+            )
+        user_id = await self.get_user_id(request)
+
+        results = [VideoBulkCreateResult(index=i) for i in range(len(data))]
+        videos: dict[int, Video] = {}
+        for i, item_data in enumerate(data):
+            try:
+                item = VideoCreateSchema.model_validate(item_data)
+            except ValidationError as e:
+                results[i].error = str(e)
+                continue
+            videos[i] = Video(
+                **item.model_dump(),
+                user_id=user_id,
+                status=VideoStatus.init,
+                task_status="init",
+            )
+
+        if videos:
+            # One quota check and one reservation for the whole batch.
+            await finance.reserve_coins_batch(
+                user_id,
+                {
+                    video.uid: video.engine_instance.price
+                    for video in videos.values()
+                },
+            )
+            try:
+                await Video.insert_many(list(videos.values()))
+            except Exception:
+                # Otherwise the reconciler would meter videos that do not exist.
+                await asyncio.gather(
+                    *(
+                        finance.release_reservation(video.uid)
+                        for video in videos.values()
+                    )
+                )
+                raise
+            background_tasks.add_task(start_processing_many, list(videos.values()))
+
+        for i, video in videos.items():
+            results[i].video = video
+        return results
+
+    async def stream_item(self, request: Request, uid: uuid.UUID):
+        user_id = await self.get_user_id(request)
+        item: Video = await self.get_item(uid, user_id=user_id)
+        return event_stream(request, f"video:{uid}", [item], until_done=True)
+
+    async def stream_items(self, request: Request):
+        user_id = await self.get_user_id(request)
+        items = await Video.find(
+            {
+                "user_id": user_id,
+                "is_deleted": False,
+                "status": {
+                    "$in": [
+                        VideoStatus.init,
+                        VideoStatus.queue,
+                        VideoStatus.waiting,
+                        VideoStatus.running,
+                        VideoStatus.processing,
+                    ]
+                },
+            },
+            projection_model=VideoListItemSchema,
+        ).to_list()
+        return event_stream(request, f"user:{user_id}", items)
+
+    async def webhook(
+        self,
+        request: Request,
+        uid: uuid.UUID,
+        data: VideoWebhookData,
+        request_id: str | None = None,
+    ):
         logging.info(f"Webhook for video {uid}, {data=}")
         item: Video = await self.get_item(uid, user_id=None)
         if item.status == "cancelled":
             return {"message": "Video has been cancelled."}
-        await process_video_webhook(item, data)
+        # The job id comes from the provider, so a late webhook of a retried
+        # submission is told apart from one of the current submission.
+        request_id = data.request_id or request_id
+        if request_id is None or request_id != item.request_id:
+            return {"message": "Webhook is not for the current submission."}
+        # Finalizing means transferring the whole video, so it is queued and
+        # acknowledged right away instead of holding the provider's request.
+        event = await VideoWebhookEvent.ingest(item, request_id, data)
+        if event is None:
+            return {"message": "Webhook already received."}
+        notify_webhook_event()
         return {}
 
 
-router = VideoRouter().router
+def sse(event: dict) -> str:
+    return f"event: progress\ndata: {json.dumps(event)}\n\n"
 
 
-@router.get("/engines")
-async def engines(text_to_video: bool | None = None, image_to_video: bool | None = None):
-    from . import engines
+def event_stream(
+    request: Request,
+    channel: str,
+    items: list[Video | VideoListItemSchema],
+    until_done: bool = False,
+) -> StreamingResponse:
+    async def events():
+        # Subscribe before the snapshot so no change falls in between.
+        async with pubsub.get_broker().subscribe(channel) as subscription:
+            for item in items:
+                yield sse(progress_event(item))
+            if until_done and all(item.status.is_done for item in items):
+                return
+            while not await request.is_disconnected():
+                event = await subscription.get(Settings.stream_heartbeat)
+                if event is None:
+                    yield ": keepalive\n\n"
+                    continue
+                yield sse(event)
+                if until_done and VideoStatus(event["status"]).is_done:
+                    return
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
 
-    engines = [
-        VideoEnginesSchema.from_model(name)
-        for name, engine in engines.AbstractEngine.get_subclasses().items()
-        if "abstract" not in engine.get_class_name()
-        and (text_to_video is None or text_to_video == engine.text_to_video)
+router = VideoRouter().router
+
+
+@functools.cache
+def engines_payload(
+    text_to_video: bool | None = None, image_to_video: bool | None = None
+) -> bytes:
+    items = [
+        VideoEnginesSchema.from_model(name).model_dump(mode="json")
+        for name, engine in get_registry().engines.items()
+        if (text_to_video is None or text_to_video == engine.text_to_video)
         and (image_to_video is None or image_to_video == engine.image_to_video)
     ]
-    return engines
+    return json.dumps(items).encode()
+
+
+@router.get("/engines", response_model=list[VideoEnginesSchema])
+async def engines(text_to_video: bool | None = None, image_to_video: bool | None = None):
+    return Response(
+        content=engines_payload(text_to_video, image_to_video),
+        media_type="application/json",
+    )
+
+
+@router.get("/engines/health")
+async def engines_health():
+    # Observations of this replica only.
+    return routing.health_report()
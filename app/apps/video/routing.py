@@ -0,0 +1,174 @@
+import time
+
+from server.config import Settings
+
+from .engines import AbstractEngine, get_registry
+
+
+class CircuitBreaker:
+    def __init__(self):
+        self.failures = 0
+        self.opened_at: float | None = None
+
+    @property
+    def is_open(self) -> bool:
+        return self.opened_at is not None and self.retry_in() > 0
+
+    def retry_in(self) -> float:
+        if self.opened_at is None:
+            return 0
+        elapsed = time.monotonic() - self.opened_at
+        return max(Settings.circuit_open_seconds - elapsed, 0)
+
+    def acquire(self) -> bool:
+        if self.opened_at is None:
+            return True
+        if self.is_open:
+            return False
+        # Half-open: one submission probes the provider and the breaker is
+        # re-armed until it reports back.
+        self.opened_at = time.monotonic()
+        return True
+
+    def success(self):
+        self.failures = 0
+        self.opened_at = None
+
+    def failure(self):
+        self.failures += 1
+        if self.failures >= Settings.circuit_failure_threshold:
+            self.opened_at = time.monotonic()
+
+
+class EngineHealth:
+    # Exponentially weighted averages of what this process observed.
+
+    def __init__(self, engine: AbstractEngine):
+        self.engine = engine
+        self.breaker = CircuitBreaker()
+        self.queue_seconds: float | None = None
+        self.latency_seconds: float | None = None
+        self.error_rate = 0.0
+
+    @staticmethod
+    def _average(current: float | None, value: float) -> float:
+        if current is None:
+            return value
+        return current + Settings.routing_ewma_alpha * (value - current)
+
+    def record_queue_time(self, seconds: float):
+        self.queue_seconds = self._average(self.queue_seconds, seconds)
+
+    def record_success(self, latency: float | None = None):
+        self.error_rate = self._average(self.error_rate, 0)
+        if latency is not None:
+            self.latency_seconds = self._average(self.latency_seconds, latency)
+        self.breaker.success()
+
+    def record_failure(self):
+        self.error_rate = self._average(self.error_rate, 1)
+        self.breaker.failure()
+
+    @property
+    def score(self) -> float:
+        # Expected seconds to a result, inflated by the recent error rate.
+        latency = self.latency_seconds or self.engine.expected_latency
+        queue = self.queue_seconds or 0
+        return (latency + queue) * (1 + Settings.routing_error_penalty * self.error_rate)
+
+    def report(self) -> dict:
+        return {
+            "engine": self.engine.get_class_name(),
+            "circuit": "open" if self.breaker.is_open else "closed",
+            "failures": self.breaker.failures,
+            "error_rate": round(self.error_rate, 3),
+            "queue_seconds": self.queue_seconds,
+            "latency_seconds": self.latency_seconds,
+            "score": round(self.score, 1),
+        }
+
+
+_health: dict[str, EngineHealth] = {}
+
+
+def get_health(engine: AbstractEngine) -> EngineHealth:
+    name = engine.get_class_name()
+    if name not in _health:
+        _health[name] = EngineHealth(engine)
+    return _health[name]
+
+
+def health_report() -> list[dict]:
+    return [get_health(engine).report() for engine in get_registry().engines.values()]
+
+
+# Aspect ratios of engines that take pixel ratios instead
+PIXEL_RATIOS = {"16:9": "1280:768", "9:16": "768:1280"}
+
+
+def capability_meta_data(
+    engine: AbstractEngine, duration: int | None, aspect_ratio: str | None
+) -> dict:
+    # Only declared fields; callers treat a missing one as unsupported.
+    fields = engine.meta_data_schema.model_fields
+    meta_data = {}
+    if duration is not None and "duration" in fields:
+        meta_data["duration"] = duration
+    if aspect_ratio is not None:
+        if "aspect_ratio" in fields:
+            meta_data["aspect_ratio"] = aspect_ratio
+        elif "ratio" in fields:
+            meta_data["ratio"] = PIXEL_RATIOS.get(aspect_ratio)
+    return meta_data
+
+
+def supports(
+    engine: AbstractEngine,
+    image_to_video: bool,
+    duration: int | None,
+    aspect_ratio: str | None,
+) -> bool:
+    if image_to_video != engine.image_to_video:
+        return False
+    if not image_to_video and not engine.text_to_video:
+        return False
+    meta_data = capability_meta_data(engine, duration, aspect_ratio)
+    # Engines that do not declare a requested field cannot honor it.
+    requested = (duration is not None) + (aspect_ratio is not None)
+    if len(meta_data) < requested:
+        return False
+    try:
+        engine.normalize_meta_data(meta_data)
+    except ValueError:
+        return False
+    return True
+
+
+def candidates(
+    image_to_video: bool,
+    duration: int | None = None,
+    aspect_ratio: str | None = None,
+    max_price: float | None = None,
+) -> list[AbstractEngine]:
+    return sorted(
+        (
+            engine
+            for engine in get_registry().engines.values()
+            if supports(engine, image_to_video, duration, aspect_ratio)
+            and (max_price is None or engine.price <= max_price)
+        ),
+        key=lambda engine: get_health(engine).score,
+    )
+
+
+def choose(
+    image_to_video: bool,
+    duration: int | None = None,
+    aspect_ratio: str | None = None,
+    max_price: float | None = None,
+) -> AbstractEngine | None:
+    engines = candidates(image_to_video, duration, aspect_ratio, max_price)
+    for engine in engines:
+        if not get_health(engine).breaker.is_open:
+            return engine
+    return None
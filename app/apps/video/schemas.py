@@ -1,13 +1,14 @@
 import uuid
+from datetime import datetime
 from enum import Enum
 from typing import Any
 
-import fal_client
 from fastapi_mongo_base.schemas import OwnedEntitySchema
 from fastapi_mongo_base.tasks import TaskMixin, TaskStatusEnum
-from pydantic import BaseModel, field_validator, model_validator
+from pydantic import AliasChoices, BaseModel, Field, field_validator, model_validator
+from utils import metrics
 
-from . import engines
+from . import engines, routing
 
 
 class VideoStatus(str, Enum):
@@ -25,7 +26,7 @@ class VideoStatus(str, Enum):
 
     @classmethod
     def from_engine(cls, status):
-        return {
+        status_map = {
             "initialized": VideoStatus.init,
             "queue": VideoStatus.queue,
             "waiting": VideoStatus.waiting,
@@ -43,8 +44,18 @@ class VideoStatus(str, Enum):
             "RUNNING": VideoStatus.processing,
             "PENDING": VideoStatus.queue,
             "CANCELLED": VideoStatus.cancelled,
-            "THROTTLED": VideoStatus.error,
-        }.get(status, VideoStatus.error)
+            # Runway holds throttled tasks in its queue; they are not failures.
+            "THROTTLED": VideoStatus.queue,
+            "starting": VideoStatus.queue,
+            "processing": VideoStatus.processing,
+            "succeeded": VideoStatus.completed,
+            "failed": VideoStatus.error,
+            "canceled": VideoStatus.cancelled,
+        }
+        if status not in status_map:
+            metrics.UNKNOWN_ENGINE_STATUS.labels(str(status)).inc()
+            return VideoStatus.error
+        return status_map[status]
 
     @classmethod
     def done_statuses(cls):
@@ -92,6 +103,7 @@ class VideoEnginesSchema(BaseModel):
     image_to_video: bool = False
     thumbnail_url: str
     price: float
+    meta_data_schema: dict = {}
 
     @classmethod
     def from_model(cls, model: str) -> "VideoEnginesSchema":
@@ -102,9 +114,35 @@ class VideoEnginesSchema(BaseModel):
             price=subclass.price,
             text_to_video=subclass.text_to_video,
             image_to_video=subclass.image_to_video,
+            meta_data_schema=subclass.meta_data_json_schema(),
         )
 
 
+class VideoCapability(BaseModel):
+    image_to_video: bool = False
+    duration: int | None = None
+    aspect_ratio: str | None = None
+
+    @model_validator(mode="before")
+    @classmethod
+    def parse_text(cls, data):
+        # Accepts the short form, e.g. "text-to-video, 5s, 16:9".
+        if not isinstance(data, str):
+            return data
+        values = {}
+        for part in data.split(","):
+            part = part.strip().lower()
+            if part in ("text-to-video", "image-to-video"):
+                values["image_to_video"] = part == "image-to-video"
+            elif ":" in part:
+                values["aspect_ratio"] = part
+            elif part.rstrip("s ").isdigit():
+                values["duration"] = int(part.rstrip("s "))
+            elif part:
+                raise ValueError(f"Unknown capability {part}")
+        return values
+
+
 class VideoCreateSchema(BaseModel):
     # prompt: str
     user_prompt: str | None = None
@@ -112,11 +150,14 @@ class VideoCreateSchema(BaseModel):
     meta_data: dict[str, Any] | None = None
     engine: str = "runway"
     webhook_url: str | None = None
+    # Accept the result of an identical earlier request instead of a new job.
+    reuse: bool = False
+    # Routing mode: the engine is picked among those with this capability.
+    capability: VideoCapability | None = None
 
     @field_validator("engine", mode="before")
     def validate_engine(cls, v: str):
-        engines.AbstractEngine.get_subclass(v)
-        return v
+        return engines.AbstractEngine.get_subclass(v).get_class_name()
 
     @field_validator("user_prompt", mode="before")
     def validate_user_prompt(cls, v: str):
@@ -126,20 +167,39 @@ class VideoCreateSchema(BaseModel):
 
     @property
     def engine_instance(self):
-        engine = engines.AbstractEngine.get_subclass(self.engine)
+        return engines.get_registry().get(self.engine)
+
+    @model_validator(mode="after")
+    def route_capability(self):
+        # Stored videos carry the engine they were routed to.
+        if self.capability is None or "engine" in self.model_fields_set:
+            return self
+        engine = routing.choose(
+            self.capability.image_to_video,
+            self.capability.duration,
+            self.capability.aspect_ratio,
+        )
         if engine is None:
-            return None
-        return engine
+            raise ValueError("No available engine has the requested capability")
+        self.engine = engine.get_class_name()
+        self.meta_data = {
+            **(self.meta_data or {}),
+            **routing.capability_meta_data(
+                engine, self.capability.duration, self.capability.aspect_ratio
+            ),
+        }
+        return self
 
     @model_validator(mode="after")
     def validate_metadata(cls, values: "VideoCreateSchema"):
-        meta_data = values.meta_data or {}
-        engine = engines.AbstractEngine.get_subclass(values.engine)
+        # Normalized once here; engines send the declared fields as stored.
+        engine = values.engine_instance
         if engine is None:
             return values
-        validated, message = engine.validate(meta_data)
-        if not validated:
-            raise ValueError(f"MetaData: {message}")
+        try:
+            values.meta_data = engine.normalize_meta_data(values.meta_data)
+        except ValueError as e:
+            raise ValueError(f"MetaData: {e}")
         return values
 
 
@@ -148,6 +208,7 @@ class VideoResponse(BaseModel):
     width: int
     height: int
     duration: float
+    sha256: str | None = None
 
 
 class VideoSchema(VideoCreateSchema, TaskMixin, OwnedEntitySchema):
@@ -167,6 +228,31 @@ class VideoSchema(VideoCreateSchema, TaskMixin, OwnedEntitySchema):
     def validate_engine(cls, v: str):
         return v
 
+    # Routing and metadata normalization ran on the create request; stored
+    # videos are not validated again.
+    @model_validator(mode="after")
+    def route_capability(self):
+        return self
+
+    @model_validator(mode="after")
+    def validate_metadata(self):
+        return self
+
+
+class VideoListItemSchema(OwnedEntitySchema):
+    # Projection for listings and streams; leaves out the task log history.
+    user_prompt: str | None = None
+    prompt: str | None = None
+    image_url: str | None = None
+    engine: str
+    status: VideoStatus = VideoStatus.draft
+    task_status: TaskStatusEnum = TaskStatusEnum.draft
+    task_report: str | None = None
+    task_progress: int = -1
+    task_start_at: datetime | None = None
+    task_end_at: datetime | None = None
+    results: VideoResponse | None = None
+
 
 class VideoWebhookPayload(BaseModel):
     video: dict | None = None
@@ -176,3 +262,13 @@ class VideoWebhookData(BaseModel):
     payload: VideoWebhookPayload | None = None
     status: VideoStatus = VideoStatus.processing
     error: Any | None = None
+    # The provider's job id, which fal sends as request_id and Luma as id.
+    request_id: str | None = Field(
+        default=None, validation_alias=AliasChoices("request_id", "id")
+    )
+
+
+class VideoBulkCreateResult(BaseModel):
+    index: int
+    video: VideoSchema | None = None
+    error: str | None = None
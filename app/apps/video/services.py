@@ -1,6 +1,12 @@
+import asyncio
+import hashlib
+import json
 import logging
-from datetime import datetime
-from apps.video.models import Video
+import uuid
+from datetime import datetime, timedelta
+from apps.video import routing
+from apps.video.engines import AbstractEngine
+from apps.video.models import Video, VideoPoll
 from apps.video.schemas import (
     VideoResponse,
     VideoStatus,
@@ -9,11 +15,37 @@ from apps.video.schemas import (
 )
 from fastapi_mongo_base.tasks import TaskStatusEnum
 from fastapi_mongo_base.utils import texttools
-from utils import ai, finance, media, video_attr
+from server.config import Settings
+from utils import ai, finance, media, metrics, pubsub, ratelimit, video_attr
+from utils.cache import TTLCache
+
+# request_hash -> (uid, results) of a completed video
+_reusable_results: TTLCache[str, tuple[uuid.UUID, VideoResponse]] = TTLCache(
+    Settings.reuse_cache_size, Settings.reuse_ttl
+)
+
+
+def progress_event(video: Video | VideoPoll) -> dict:
+    return video.model_dump(
+        include={"uid", "status", "task_status", "task_progress", "results"},
+        mode="json",
+    )
+
+
+async def publish_progress(video: Video | VideoPoll):
+    event = progress_event(video)
+    await asyncio.gather(
+        pubsub.publish(f"video:{video.uid}", event),
+        pubsub.publish(f"user:{video.user_id}", event),
+    )
+
+
+Video.add_signal(publish_progress)
 
 
 async def get_attributes(file_url: str):
-    data = await video_attr.get_attributes(file_url)
+    with metrics.STEP_SECONDS.labels("get_attributes").time():
+        data = await video_attr.get_attributes(file_url)
     url = data.pop("url", None) or file_url
     logging.info(f"get attributes {data}")
     return VideoResponse(**data, url=url)
@@ -21,26 +53,165 @@ async def get_attributes(file_url: str):
 
 async def create_prompt(user_prompt: str):
     # Translate prompt using ai
-    prompt = await ai.translate(user_prompt)
+    with metrics.STEP_SECONDS.labels("translate").time():
+        prompt = await ai.translate(user_prompt)
     prompt = prompt.strip(",").strip()
     return prompt
 
 
+def schedule_next_poll(video: Video | VideoPoll):
+    # Wait until the engine is likely done, then back off in proportion to how
+    # overdue the job is, which grows the interval geometrically per poll.
+    now = datetime.now()
+    engine = video.engine_instance
+    expected = engine.expected_latency if engine else Settings.poll_min_interval
+    elapsed = (now - (video.task_start_at or now)).total_seconds()
+    if elapsed < expected:
+        delay = expected - elapsed
+    else:
+        delay = (elapsed - expected) * Settings.poll_backoff_factor
+    delay = min(max(delay, Settings.poll_min_interval), Settings.poll_max_interval)
+    video.next_poll_at = now + timedelta(seconds=delay)
+
+
+def request_hash(video: Video) -> str:
+    # Results are only shared between requests of the same user.
+    request = {
+        "user_id": str(video.user_id),
+        "engine": video.engine,
+        "user_prompt": ai.normalize_text(video.user_prompt or ""),
+        "image_url": video.image_url,
+        "meta_data": video.meta_data or {},
+    }
+    canonical = json.dumps(request, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+async def complete_from(video: Video, results: VideoResponse, source_uid: uuid.UUID):
+    video.results = results
+    video.reuse_of = source_uid
+    video.retry_at = None
+    video.task_progress = 100
+    video.status = VideoStatus.completed
+    video.task_status = TaskStatusEnum.completed
+    video.task_end_at = datetime.now()
+    await video.save_report(f"Reused the result of video {source_uid}.")
+
+
+async def reuse_result(video: Video) -> bool:
+    cached = _reusable_results.get(video.request_hash)
+    if cached is not None:
+        source_uid, results = cached
+        await complete_from(video, results, source_uid)
+        return True
+
+    source = await Video.find(
+        {
+            "request_hash": {"$type": "string", "$eq": video.request_hash},
+            "created_at": {"$gte": datetime.now() - timedelta(seconds=Settings.reuse_ttl)},
+            "uid": {"$ne": video.uid},
+            "reuse_of": None,
+            "is_deleted": False,
+            "status": {"$nin": [VideoStatus.error, VideoStatus.cancelled]},
+        }
+    ).sort("-created_at").first_or_none()
+    if source is None:
+        return False
+
+    if source.status == VideoStatus.completed and source.results:
+        _reusable_results.set(video.request_hash, (source.uid, source.results))
+        await complete_from(video, source.results, source.uid)
+        return True
+
+    # Attached videos are finished by finish_attached when the source is done;
+    # retry_at only wakes them up if that never happens.
+    video.reuse_of = source.uid
+    video.status = VideoStatus.queue
+    video.task_status = TaskStatusEnum.processing
+    video.retry_at = datetime.now() + timedelta(seconds=Settings.reuse_attach_timeout)
+    await video.save_report(f"Waiting for video {source.uid} with the same request.")
+    return True
+
+
+async def finish_attached(source: Video):
+    if source.request_hash:
+        _reusable_results.set(source.request_hash, (source.uid, source.results))
+    attached = await Video.find(
+        {
+            "reuse_of": {"$type": "binData", "$eq": source.uid},
+            "status": {"$nin": VideoStatus.done_statuses()},
+        }
+    ).to_list()
+    for video in attached:
+        await complete_from(video, source.results, source.uid)
+
+
+def is_retryable_error(error: Exception) -> bool:
+    if isinstance(error, (ValueError, TypeError)):
+        return False
+    status_code = ratelimit.error_status_code(error)
+    if status_code is not None and 400 <= status_code < 500:
+        return status_code in {408, 409, 425, 429}
+    return True
+
+
+def reroute(video: Video) -> AbstractEngine | None:
+    # Only routed videos may move, and never to a pricier engine than the one
+    # their coins were reserved for.
+    if video.capability is None:
+        return None
+    engine = routing.choose(
+        video.capability.image_to_video,
+        video.capability.duration,
+        video.capability.aspect_ratio,
+        max_price=video.engine_instance.price,
+    )
+    if engine is None or not routing.get_health(engine).breaker.acquire():
+        return None
+    video.engine = engine.get_class_name()
+    video.meta_data = {
+        **(video.meta_data or {}),
+        **routing.capability_meta_data(
+            engine, video.capability.duration, video.capability.aspect_ratio
+        ),
+    }
+    return engine
+
+
 async def video_request(video: Video):
     try:
+        video.retry_at = None
         video.task_start_at = datetime.now()
-        prompt = await create_prompt(video.user_prompt)
-        video.prompt = prompt
+        video.request_hash = video.request_hash or request_hash(video)
+        if video.reuse and await reuse_result(video):
+            return video
+        video.reuse_of = None
+        # Retries keep the prompt translated on the first attempt.
+        if not video.prompt:
+            video.prompt = await create_prompt(video.user_prompt)
         engine = video.engine_instance
+        health = routing.get_health(engine)
+        if not health.breaker.acquire():
+            engine = reroute(video)
+            if engine is None:
+                delay = max(health.breaker.retry_in(), Settings.poll_min_interval)
+                await video.requeue(
+                    f"{video.engine} is unavailable, resubmitting in {delay:.0f}s",
+                    delay,
+                )
+                return video
+            health = routing.get_health(engine)
         video.request_id = await engine.generate_async(
             video.prompt,
             image_url=video.image_url,
             meta_data=video.meta_data,
             webhook_url=video.item_webhook_url,
         )
+        health.breaker.success()
         video.task_progress = 5
         video.task_status = TaskStatusEnum.processing
         video.status = VideoStatus.processing
+        schedule_next_poll(video)
         await video.save_report(
             f"{video.engine_instance.get_class_name()} has been requested."
         )
@@ -50,50 +221,112 @@ async def video_request(video: Video):
         traceback_str = "".join(traceback.format_tb(e.__traceback__))
         logging.error(f"Error updating imagination status: \n{traceback_str}\n{e}")
 
-        video.status = VideoStatus.error
-        video.task_status = VideoStatus.error.task_status
-        await video.fail(f"{type(e)}: {e}")
+        if ratelimit.is_rate_limited(e):
+            delay = ratelimit.retry_after(e) or Settings.retry_base_delay
+            metrics.RETRIES.labels("throttled").inc()
+            await video.requeue(f"Throttled, resubmitting in {delay:.0f}s", delay)
+            return video
+        retryable = is_retryable_error(e)
+        if retryable and video.engine_instance:
+            routing.get_health(video.engine_instance).record_failure()
+        await video.retry(f"{type(e)}: {e}", retryable=retryable)
         return video
 
 
-async def get_update(video: Video):
+async def get_update(poll: VideoPoll):
     # Get and convert fal status to VideoStatus
-    engine = video.engine_instance
+    engine = poll.engine_instance
     if engine is None:
-        logging.error(f"Engine {video.engine} not found")
+        logging.error(f"Engine {poll.engine} not found")
         return
-    status = await engine.get_status(video.request_id)
-    video.status = VideoStatus.from_engine(status)
+    snapshot = await engine.poll(poll.request_id)
+    previous = (poll.status, poll.task_progress)
+    status = VideoStatus.from_engine(snapshot.status)
+    progress = poll.task_progress
+    if snapshot.progress is not None:
+        progress = max(progress, snapshot.progress)
+
+    if status == poll.status:
+        # Most polls only move the progress and the next poll time.
+        schedule_next_poll(poll)
+        await poll.set_fields(task_progress=progress, next_poll_at=poll.next_poll_at)
+        if progress != previous[1]:
+            await publish_progress(poll)
+        return
+
+    # Status changes go through the document, so rollups and signals follow.
+    video = await poll.hydrate()
+    if video is None:
+        return
+    video.status = status
+    video.task_progress = progress
+    if (
+        video.status == VideoStatus.processing
+        and previous[0] != video.status
+        and video.task_start_at
+    ):
+        routing.get_health(engine).record_queue_time(
+            (datetime.now() - video.task_start_at).total_seconds()
+        )
 
     # Check video status
     if video.status.is_done:
         payload: VideoWebhookPayload | None = None
-        # Getting the video payload if the status was successful
+        # The snapshot already carries the result if the status was successful
         if video.status.is_success:
-            results = await engine.get_result(video.request_id)
-            payload = VideoWebhookPayload(video=results.model_dump())
+            payload = VideoWebhookPayload(video=snapshot.model_dump())
         # Delivery of the results to the web process
         await process_video_webhook(
-            video, VideoWebhookData(status=video.status, payload=payload)
+            video,
+            VideoWebhookData(
+                status=video.status, payload=payload, error=snapshot.error
+            ),
         )
+    else:
+        schedule_next_poll(video)
     await video.save()
+    # Emitted saves publish through the signal; plain polls only on change.
+    if not video.status.is_done and previous != (video.status, video.task_progress):
+        await publish_progress(video)
 
 
 async def process_video_webhook(video: Video, data: VideoWebhookData):
+    engine = video.engine_instance
     if data.status == VideoStatus.error:
+        if engine:
+            routing.get_health(engine).record_failure()
         await video.retry(data.error)
         return
 
     if data.status.is_success:
+        if engine and video.task_start_at:
+            routing.get_health(engine).record_success(
+                (datetime.now() - video.task_start_at).total_seconds()
+            )
         result_url = data.payload.video.get("url", "")
         filename = texttools.sanitize_filename(video.prompt)
-        file = await media.upload_url(
-            result_url,
-            str(video.user_id),
-            f"video-{filename}.mp4",
-            file_upload_dir="videogens",
-        )
-        attributes = await get_attributes(file.url)
+        if Settings.relay_uploads:
+            with metrics.STEP_SECONDS.labels("upload").time():
+                relay = await media.relay_url(
+                    result_url,
+                    str(video.user_id),
+                    f"video-{filename}.mp4",
+                    file_upload_dir="videogens",
+                )
+            if relay.metadata:
+                attributes = VideoResponse(**relay.metadata, url=relay.file.url)
+            else:
+                attributes = await get_attributes(relay.file.url)
+            attributes.sha256 = relay.sha256.hexdigest()
+        else:
+            with metrics.STEP_SECONDS.labels("upload").time():
+                file = await media.upload_url(
+                    result_url,
+                    str(video.user_id),
+                    f"video-{filename}.mp4",
+                    file_upload_dir="videogens",
+                )
+            attributes = await get_attributes(file.url)
         video.results = attributes
         video.task_progress = 100
         video.status = VideoStatus.completed
@@ -107,18 +340,39 @@ async def process_video_webhook(video: Video, data: VideoWebhookData):
         )
 
         await video.save_report(report)
+        await finish_attached(video)
 
     logging.info(f"Video webhook {video.uid} {data.status}")
 
 
-async def register_cost(video: Video):
-    usage = await finance.meter_cost(video.user_id, video.engine_instance.price)
-    if usage is None:
-        logging.error(
-            f"Insufficient balance. {video.user_id} {video.engine_instance.get_class_name()}"
-        )
-        await video.fail("Insufficient balance.")
-        return
+async def start_processing_many(videos: list[Video]):
+    semaphore = asyncio.Semaphore(Settings.bulk_concurrency)
+
+    async def start(video: Video):
+        async with semaphore:
+            await video.start_processing()
 
-    video.usage_id = usage.uid
+    await asyncio.gather(*[start(video) for video in videos], return_exceptions=True)
+
+
+async def count_in_flight():
+    # Refreshed on scrape; served by the status index.
+    query = Video.in_flight_query()
+    counts = dict.fromkeys(query["status"]["$in"], 0)
+    async for row in Video.get_motor_collection().aggregate(
+        [
+            {"$match": query},
+            {"$group": {"_id": "$status", "count": {"$sum": 1}}},
+        ]
+    ):
+        counts[row["_id"]] = row["count"]
+    for status, count in counts.items():
+        metrics.VIDEOS_IN_FLIGHT.labels(status).set(count)
+
+
+async def register_cost(video: Video):
+    # Raises InsufficientFunds; the usage itself is created in UFaaS later.
+    await finance.reserve_coins(
+        video.user_id, video.engine_instance.price, video.uid
+    )
     return video
@@ -1,32 +1,181 @@
+import asyncio
 import logging
+from collections import defaultdict
+from datetime import datetime, timedelta
 
 from fastapi_mongo_base.utils import basic
+from server.config import Settings
+from utils import finance, metrics, ratelimit
 
-from .models import Video
-from .schemas import VideoStatus
-from .services import get_update
+from .models import Video, VideoPoll, VideoWebhookEvent
+from .services import get_update, process_video_webhook
 
+_update_lock = asyncio.Lock()
+_retry_lock = asyncio.Lock()
+_webhook_wakeup = asyncio.Event()
 
-@basic.try_except_wrapper
-async def update_video():
-    data: list[Video] = (
-        await Video.get_query()
-        .find(
-            {
-                "request_id": {"$ne": None},
-                # "created_at": {"$lte": datetime.now() - timedelta(minutes=3)},
-                "status": {"$nin": VideoStatus.done_statuses()},
-            }
-        )
-        .to_list()
-    )
 
-    for video in data:
+async def _update(
+    poll: VideoPoll,
+    engine_semaphore: asyncio.Semaphore,
+    semaphore: asyncio.Semaphore,
+):
+    # The engine slot is taken first, so polls waiting on a busy engine do not
+    # hold global slots that polls of other engines could use.
+    async with engine_semaphore, semaphore:
         try:
-            await get_update(video)
+            await get_update(poll)
         except Exception as e:
+            if ratelimit.is_rate_limited(e):
+                delay = ratelimit.retry_after(e) or Settings.poll_min_interval
+                await poll.set_fields(
+                    next_poll_at=datetime.now() + timedelta(seconds=delay)
+                )
+                return
+
             import traceback
 
             traceback_str = "".join(traceback.format_tb(e.__traceback__))
             logging.error(f"update video failed {type(e)} {e}\n{traceback_str}")
-            await video.fail(f"update video failed {type(e)} {e}")
+            video = await poll.hydrate()
+            if video:
+                await video.fail(f"update video failed {type(e)} {e}")
+        finally:
+            await poll.release_lease()
+
+
+@basic.try_except_wrapper
+async def update_video():
+    if _update_lock.locked():
+        logging.warning("update_video: previous cycle is still running, skipped")
+        return
+
+    async with _update_lock:
+        semaphore = asyncio.Semaphore(Settings.update_concurrency)
+        engine_semaphores: dict[str, asyncio.Semaphore] = defaultdict(
+            lambda: asyncio.Semaphore(Settings.update_engine_concurrency)
+        )
+        tasks: set[asyncio.Task] = set()
+        items = 0
+
+        started_at = datetime.now()
+        with metrics.UPDATE_CYCLE_SECONDS.time():
+            while True:
+                # The next batch is claimed once the queued polls fit in the
+                # global slots, so claiming does not outrun the pollers and
+                # memory stays bounded.
+                while len(tasks) >= Settings.update_concurrency:
+                    await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                polls = await Video.claim_due(Settings.update_batch_size, started_at)
+                if not polls:
+                    break
+                items += len(polls)
+                for poll in polls:
+                    task = asyncio.create_task(
+                        _update(poll, engine_semaphores[poll.engine], semaphore)
+                    )
+                    task.add_done_callback(tasks.discard)
+                    tasks.add(task)
+
+            await asyncio.gather(*tasks)
+        metrics.UPDATE_CYCLE_ITEMS.observe(items)
+
+
+async def _retry(video: Video):
+    try:
+        await video.start_processing()
+    finally:
+        await video.release_lease()
+
+
+@basic.try_except_wrapper
+async def retry_videos():
+    if _retry_lock.locked():
+        logging.warning("retry_videos: previous cycle is still running, skipped")
+        return
+
+    async with _retry_lock:
+        semaphore = asyncio.Semaphore(Settings.retry_concurrency)
+        tasks: set[asyncio.Task] = set()
+
+        started_at = datetime.now()
+        while videos := await Video.claim_due_retries(
+            Settings.update_batch_size, started_at
+        ):
+            for video in videos:
+                await semaphore.acquire()
+                task = asyncio.create_task(_retry(video))
+                task.add_done_callback(lambda _: semaphore.release())
+                task.add_done_callback(tasks.discard)
+                tasks.add(task)
+
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def notify_webhook_event():
+    _webhook_wakeup.set()
+
+
+async def _process_webhook_event(event: VideoWebhookEvent):
+    try:
+        video = await Video.claim(event.video_uid)
+        if video is None:
+            # A poller or another replica holds the video; try again shortly.
+            await event.postpone(Settings.poll_min_interval)
+            return
+
+        try:
+            # Events for a submission that has since been retried are stale.
+            if (
+                not video.status.is_done
+                and video.request_id is not None
+                and video.request_id == event.request_id
+            ):
+                await process_video_webhook(video, event.webhook_data)
+                await video.save()
+        finally:
+            await video.release_lease()
+        await event.mark_processed()
+    except Exception as e:
+        import traceback
+
+        traceback_str = "".join(traceback.format_tb(e.__traceback__))
+        logging.error(f"webhook event failed {type(e)} {e}\n{traceback_str}")
+        if event.attempts >= Settings.webhook_max_attempts:
+            await event.mark_processed()
+
+
+@basic.try_except_wrapper
+async def process_webhook_events():
+    semaphore = asyncio.Semaphore(Settings.webhook_concurrency)
+    tasks: set[asyncio.Task] = set()
+    while True:
+        await semaphore.acquire()
+        event = await VideoWebhookEvent.claim_next()
+        if event is None:
+            semaphore.release()
+            break
+        task = asyncio.create_task(_process_webhook_event(event))
+        task.add_done_callback(lambda _: semaphore.release())
+        task.add_done_callback(tasks.discard)
+        tasks.add(task)
+
+    await asyncio.gather(*tasks)
+
+
+async def consume_webhook_events():
+    while True:
+        try:
+            await asyncio.wait_for(_webhook_wakeup.wait(), Settings.update_time)
+        except asyncio.TimeoutError:
+            pass
+        _webhook_wakeup.clear()
+        await process_webhook_events()
+
+
+@basic.try_except_wrapper
+async def reconcile_usages():
+    for video_uid, usage_id in await finance.reconcile_reservations():
+        await Video.find_one({"uid": video_uid}).update(
+            {"$set": {"usage_id": usage_id}}
+        )
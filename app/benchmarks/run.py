@@ -0,0 +1,197 @@
+"""CPU microbenchmarks for the per-request paths; no network or database.
+
+Run from the app directory:
+
+    python -m benchmarks.run                  # compare against baseline.json
+    python -m benchmarks.run --save-baseline  # record a new baseline
+"""
+
+import argparse
+import json
+import sys
+import time
+import tracemalloc
+import uuid
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Callable
+
+from apps.video import engines
+from apps.video.models import VideoPoll
+from apps.video.schemas import (
+    VideoCreateSchema,
+    VideoEnginesSchema,
+    VideoSchema,
+    VideoStatus,
+)
+from beanie.odm.utils.encoder import Encoder
+from beanie.odm.utils.projection import get_projection
+from bson import ObjectId
+from fastapi_mongo_base.tasks import TaskLogRecord
+
+BASELINE = Path(__file__).with_name("baseline.json")
+
+create_payload = {
+    "user_prompt": "A red fox running through fresh snow at sunrise",
+    "image_url": "https://example.com/fox.png",
+    "meta_data": {"duration": 5, "aspect_ratio": "16:9"},
+    "engine": "kling-video",
+}
+engine_statuses = ["IN_PROGRESS", "completed", "SUCCEEDED", "processing", "unknown"]
+
+
+def engines_listing() -> bytes:
+    # What /engines renders before its response is memoized.
+    return json.dumps(
+        [
+            VideoEnginesSchema.from_model(name).model_dump(mode="json")
+            for name in engines.get_registry().engines
+        ]
+    ).encode()
+
+
+def video_with_history(size: int) -> VideoSchema:
+    # VideoSchema carries every Video field; the document class itself needs
+    # an initialized database to be instantiated.
+    return VideoSchema(
+        user_id=uuid.uuid4(),
+        engine="kling",
+        user_prompt=create_payload["user_prompt"],
+        prompt=create_payload["user_prompt"],
+        meta_data=create_payload["meta_data"],
+        task_logs=[
+            TaskLogRecord(
+                reported_at=datetime.now(),
+                message=f"Video task update {i}",
+                task_status="processing",
+            )
+            for i in range(size)
+        ],
+    )
+
+
+def status_lookups():
+    for status in engine_statuses:
+        video_status = VideoStatus.from_engine(status)
+        video_status.is_done
+        video_status.task_status
+
+
+def build_cases() -> dict[str, Callable[[], Any]]:
+    video = video_with_history(500)
+    encoded = Encoder().encode(video)
+    dumped = video.model_dump()
+    # What the poll loop receives for the same document.
+    projection = get_projection(VideoPoll)
+    polled = {
+        field: value for field, value in encoded.items() if field in projection
+    } | {"_id": ObjectId(), "request_id": "request"}
+    return {
+        "create_schema_validate": lambda: VideoCreateSchema.model_validate(
+            create_payload
+        ),
+        "video_schema_validate": lambda: VideoSchema.model_validate(dumped),
+        "get_subclass": lambda: engines.AbstractEngine.get_subclass("Kling Video"),
+        "status_lookups": status_lookups,
+        "engines_listing": engines_listing,
+        "video_encode_500_logs": lambda: Encoder().encode(video),
+        "video_decode_500_logs": lambda: VideoSchema.model_validate(encoded),
+        "video_poll_decode": lambda: VideoPoll.model_validate(polled),
+        "video_dump_json_500_logs": lambda: video.model_dump_json(),
+    }
+
+
+def ops_per_sec(fn: Callable[[], Any], min_time: float, repeat: int) -> float:
+    number = 1
+    while True:
+        started = time.process_time()
+        for _ in range(number):
+            fn()
+        elapsed = time.process_time() - started
+        if elapsed >= min_time:
+            break
+        number *= 2
+
+    best = 0.0
+    for _ in range(repeat):
+        started = time.process_time()
+        for _ in range(number):
+            fn()
+        best = max(best, number / (time.process_time() - started))
+    return best
+
+
+def peak_bytes(fn: Callable[[], Any]) -> int:
+    fn()  # warm caches so one-off setup is not counted
+    tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        baseline, _ = tracemalloc.get_traced_memory()
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak - baseline
+
+
+def run(min_time: float, repeat: int) -> dict[str, dict]:
+    results = {}
+    for name, fn in build_cases().items():
+        results[name] = {
+            "ops_per_sec": round(ops_per_sec(fn, min_time, repeat), 1),
+            "peak_bytes": peak_bytes(fn),
+        }
+    return results
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if result["ops_per_sec"] < base["ops_per_sec"] * (1 - tolerance):
+            regressions.append(
+                f"{name}: {result['ops_per_sec']} ops/s, "
+                f"baseline {base['ops_per_sec']}"
+            )
+        if result["peak_bytes"] > base["peak_bytes"] * (1 + tolerance):
+            regressions.append(
+                f"{name}: {result['peak_bytes']} peak bytes, "
+                f"baseline {base['peak_bytes']}"
+            )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=0.3)
+    parser.add_argument("--min-time", type=float, default=0.2)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    results = run(args.min_time, args.repeat)
+    baseline = json.loads(BASELINE.read_text()) if BASELINE.exists() else {}
+
+    print(f"{'benchmark':<28}{'ops/sec':>14}{'baseline':>14}{'peak bytes':>14}")
+    for name, result in results.items():
+        base = baseline.get(name, {}).get("ops_per_sec", "-")
+        print(
+            f"{name:<28}{result['ops_per_sec']:>14}{base:>14}"
+            f"{result['peak_bytes']:>14}"
+        )
+
+    if args.save_baseline:
+        BASELINE.write_text(json.dumps(results, indent=2) + "\n")
+        print(f"Baseline saved to {BASELINE}")
+        return
+
+    regressions = compare(results, baseline, args.tolerance)
+    if regressions:
+        print("Regressions:", *regressions, sep="\n  ")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
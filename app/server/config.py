@@ -2,6 +2,7 @@
 
 import dataclasses
 import os
+import socket
 from pathlib import Path
 
 import dotenv
@@ -17,6 +18,84 @@ class Settings(config.Settings):
     base_dir: Path = Path(__file__).resolve().parent.parent
     base_path: str = "/v1/apps/videogen"
     update_time: int = int(os.getenv("TASK_UPDATE_TIME", 10))
+    update_batch_size: int = int(os.getenv("TASK_UPDATE_BATCH_SIZE", 100))
+    update_concurrency: int = int(os.getenv("TASK_UPDATE_CONCURRENCY", 32))
+    update_engine_concurrency: int = int(
+        os.getenv("TASK_UPDATE_ENGINE_CONCURRENCY", 8)
+    )
+    poll_min_interval: int = int(os.getenv("POLL_MIN_INTERVAL", 10))
+    poll_max_interval: int = int(os.getenv("POLL_MAX_INTERVAL", 300))
+    poll_backoff_factor: float = float(os.getenv("POLL_BACKOFF_FACTOR", 0.5))
+    worker_id: str = os.getenv("WORKER_ID") or f"{socket.gethostname()}-{os.getpid()}"
+    lease_duration: int = int(os.getenv("WORKER_LEASE_DURATION", 300))
+    drop_stale_indexes: bool = os.getenv("DROP_STALE_INDEXES", "false") == "true"
+
+    http_max_connections: int = int(os.getenv("HTTP_MAX_CONNECTIONS", 100))
+    http_max_keepalive_connections: int = int(
+        os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS", 20)
+    )
+    http_keepalive_expiry: float = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", 30))
+
+    translation_cache_size: int = int(os.getenv("TRANSLATION_CACHE_SIZE", 10000))
+    translation_cache_ttl: int = int(os.getenv("TRANSLATION_CACHE_TTL", 30 * 86400))
+
+    retry_base_delay: int = int(os.getenv("RETRY_BASE_DELAY", 10))
+    retry_max_delay: int = int(os.getenv("RETRY_MAX_DELAY", 600))
+    retry_concurrency: int = int(os.getenv("RETRY_CONCURRENCY", 8))
+
+    webhook_concurrency: int = int(os.getenv("WEBHOOK_CONCURRENCY", 8))
+    webhook_max_attempts: int = int(os.getenv("WEBHOOK_MAX_ATTEMPTS", 5))
+    webhook_event_ttl: int = int(os.getenv("WEBHOOK_EVENT_TTL", 7 * 86400))
+
+    relay_uploads: bool = os.getenv("RELAY_UPLOADS", "false").lower() == "true"
+    relay_chunk_size: int = int(os.getenv("RELAY_CHUNK_SIZE", 1024 * 1024))
+
+    # Progress streams; set PUBSUB_REDIS_URL to share events across replicas
+    pubsub_redis_url: str | None = os.getenv("PUBSUB_REDIS_URL")
+    stream_queue_size: int = int(os.getenv("STREAM_QUEUE_SIZE", 100))
+    stream_heartbeat: int = int(os.getenv("STREAM_HEARTBEAT", 15))
+
+    # Provider limits: requests per second (0 disables), burst and calls in flight
+    fal_rate_limit: float = float(os.getenv("FAL_RATE_LIMIT", 10))
+    fal_rate_burst: int = int(os.getenv("FAL_RATE_BURST", 20))
+    fal_concurrency: int = int(os.getenv("FAL_CONCURRENCY", 32))
+    runway_rate_limit: float = float(os.getenv("RUNWAY_RATE_LIMIT", 5))
+    runway_rate_burst: int = int(os.getenv("RUNWAY_RATE_BURST", 10))
+    runway_concurrency: int = int(os.getenv("RUNWAY_CONCURRENCY", 16))
+    replicate_rate_limit: float = float(os.getenv("REPLICATE_RATE_LIMIT", 10))
+    replicate_rate_burst: int = int(os.getenv("REPLICATE_RATE_BURST", 20))
+    replicate_concurrency: int = int(os.getenv("REPLICATE_CONCURRENCY", 32))
+
+    quota_sync_interval: int = int(os.getenv("QUOTA_SYNC_INTERVAL", 60))
+    billing_concurrency: int = int(os.getenv("BILLING_CONCURRENCY", 8))
+    billing_batch_size: int = int(os.getenv("BILLING_BATCH_SIZE", 100))
+
+    # Opt-in reuse of results of identical requests
+    reuse_ttl: int = int(os.getenv("RESULT_REUSE_TTL", 24 * 3600))
+    reuse_cache_size: int = int(os.getenv("RESULT_REUSE_CACHE_SIZE", 10000))
+    reuse_attach_timeout: int = int(os.getenv("RESULT_REUSE_ATTACH_TIMEOUT", 900))
+
+    # Capability routing and per-engine circuit breaking
+    routing_ewma_alpha: float = float(os.getenv("ROUTING_EWMA_ALPHA", 0.2))
+    routing_error_penalty: float = float(os.getenv("ROUTING_ERROR_PENALTY", 4))
+    circuit_failure_threshold: int = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", 5))
+    circuit_open_seconds: int = int(os.getenv("CIRCUIT_OPEN_SECONDS", 60))
+
+    # Thread pool for blocking SDK calls; LOOP_STALL_THRESHOLD (ms) > 0 logs
+    # event-loop stalls longer than that
+    blocking_pool_size: int = int(os.getenv("BLOCKING_POOL_SIZE", 16))
+    blocking_timeout: float = float(os.getenv("BLOCKING_TIMEOUT", 60))
+    loop_stall_threshold: int = int(os.getenv("LOOP_STALL_THRESHOLD", 0))
+
+    # Extra modules defining engines, comma separated
+    engine_plugins: tuple[str, ...] = tuple(
+        module.strip()
+        for module in os.getenv("ENGINE_PLUGINS", "").split(",")
+        if module.strip()
+    )
+
+    bulk_max_items: int = int(os.getenv("BULK_MAX_ITEMS", 100))
+    bulk_concurrency: int = int(os.getenv("BULK_CONCURRENCY", 8))
 
     fal_key: str = os.getenv("FAL_KEY")
     runway_key: str = os.getenv("RUNWAY_KEY")
@@ -1,8 +1,42 @@
+from contextlib import asynccontextmanager
+
+from apps.video.engines import get_registry
+from apps.video.models import check_query_plans, sync_indexes
 from apps.video.routes import router as video_router
+from apps.video.services import count_in_flight
+from fastapi import Response
 from fastapi_mongo_base.core import app_factory
+from utils import blocking, clients, importtime, metrics, pubsub
 
 from . import config, worker
 
-app = app_factory.create_app(worker=worker.worker, settings=config.Settings())
+
+@asynccontextmanager
+async def lifespan(app):
+    init_functions = [
+        blocking.start_stall_monitor,
+        get_registry,
+        sync_indexes,
+        check_query_plans,
+        importtime.report,
+    ]
+    async with app_factory.lifespan(
+        app, worker.worker, init_functions, config.Settings()
+    ):
+        yield
+    blocking.stop_stall_monitor()
+    blocking.shutdown()
+    await clients.close_clients()
+    await pubsub.close_broker()
+
+
+app = app_factory.create_app(settings=config.Settings(), lifespan_func=lifespan)
 
 app.include_router(video_router, prefix=f"{config.Settings.base_path}")
+
+
+@app.get("/metrics", include_in_schema=False)
+async def prometheus_metrics():
+    await count_in_flight()
+    content, media_type = metrics.render()
+    return Response(content=content, media_type=media_type)
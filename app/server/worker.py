@@ -2,7 +2,13 @@ import asyncio
 import logging
 
 # import pytz
-from apps.video.worker import update_video
+from apps.video.models import backfill_rollups
+from apps.video.worker import (
+    consume_webhook_events,
+    reconcile_usages,
+    retry_videos,
+    update_video,
+)
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 
 from .config import Settings
@@ -14,13 +20,38 @@ logging.getLogger("apscheduler").setLevel(logging.WARNING)
 async def worker():
     await update_video()
     scheduler = AsyncIOScheduler()
-    scheduler.add_job(update_video, "interval", seconds=Settings.update_time)
+    scheduler.add_job(
+        update_video,
+        "interval",
+        seconds=Settings.update_time,
+        max_instances=1,
+        coalesce=True,
+    )
+    scheduler.add_job(
+        retry_videos,
+        "interval",
+        seconds=Settings.update_time,
+        max_instances=1,
+        coalesce=True,
+    )
+
+    scheduler.add_job(
+        reconcile_usages,
+        "interval",
+        seconds=Settings.update_time,
+        max_instances=1,
+        coalesce=True,
+    )
 
     scheduler.start()
+    webhook_consumer = asyncio.create_task(consume_webhook_events())
+    rollup_backfill = asyncio.create_task(backfill_rollups())
 
     try:
         await asyncio.Event().wait()
     except (KeyboardInterrupt, SystemExit):
         pass
     finally:
+        webhook_consumer.cancel()
+        rollup_backfill.cancel()
         scheduler.shutdown()
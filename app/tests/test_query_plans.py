@@ -0,0 +1,37 @@
+import asyncio
+import os
+import uuid
+
+import pytest
+
+motor_asyncio = pytest.importorskip("motor.motor_asyncio")
+
+from beanie import init_beanie  # noqa: E402
+
+from apps.video.models import Video, VideoWebhookEvent, query_plans  # noqa: E402
+
+MONGO_URI = os.getenv("TEST_MONGO_URI")
+
+pytestmark = pytest.mark.skipif(
+    MONGO_URI is None, reason="TEST_MONGO_URI is not set"
+)
+
+
+async def worker_query_plans() -> dict[str, list[str]]:
+    client = motor_asyncio.AsyncIOMotorClient(MONGO_URI)
+    database = client.get_database(f"videogen_test_{uuid.uuid4().hex[:8]}")
+    try:
+        await init_beanie(
+            database=database, document_models=[Video, VideoWebhookEvent]
+        )
+        return await query_plans()
+    finally:
+        await client.drop_database(database.name)
+        client.close()
+
+
+def test_worker_queries_use_indexes():
+    plans = asyncio.run(worker_query_plans())
+    assert set(plans) == {"poll", "retry", "webhook", "in_flight"}
+    for name, stages in plans.items():
+        assert "COLLSCAN" not in stages, f"{name} query plan: {stages}"
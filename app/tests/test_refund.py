@@ -0,0 +1,40 @@
+import asyncio
+import uuid
+from types import SimpleNamespace
+
+import pytest
+
+finance = pytest.importorskip("utils.finance", exc_type=ImportError)
+
+from apps.video.models import Video  # noqa: E402
+
+
+def refund(monkeypatch, video, reserved: bool) -> list[uuid.UUID]:
+    cancelled = []
+
+    async def release_reservation(video_uid):
+        return reserved
+
+    async def cancel_usage(usage_id):
+        cancelled.append(usage_id)
+
+    monkeypatch.setattr(finance, "release_reservation", release_reservation)
+    monkeypatch.setattr(finance, "cancel_usage", cancel_usage)
+    asyncio.run(Video.refund(video))
+    return cancelled
+
+
+def test_legacy_video_cancels_its_usage(monkeypatch):
+    # Charged at creation, before reservations existed.
+    video = SimpleNamespace(uid=uuid.uuid4(), usage_id=uuid.uuid4())
+    assert refund(monkeypatch, video, reserved=False) == [video.usage_id]
+
+
+def test_reserved_video_leaves_usage_to_the_reconciler(monkeypatch):
+    video = SimpleNamespace(uid=uuid.uuid4(), usage_id=uuid.uuid4())
+    assert refund(monkeypatch, video, reserved=True) == []
+
+
+def test_video_without_usage_cancels_nothing(monkeypatch):
+    video = SimpleNamespace(uid=uuid.uuid4(), usage_id=None)
+    assert refund(monkeypatch, video, reserved=False) == []
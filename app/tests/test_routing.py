@@ -0,0 +1,34 @@
+from apps.video import routing
+from apps.video.engines import get_registry
+
+
+def names(engines) -> set[str]:
+    return {engine.get_class_name() for engine in engines}
+
+
+def test_duration_excludes_engines_without_the_field():
+    registry = get_registry().engines.values()
+    lacking = {
+        engine.get_class_name()
+        for engine in registry
+        if engine.text_to_video
+        and "duration" not in engine.meta_data_schema.model_fields
+    }
+    assert lacking, "expected a text-to-video engine without a duration field"
+
+    candidates = names(routing.candidates(False, 7))
+    assert candidates
+    assert not candidates & lacking
+    for engine in routing.candidates(False, 7):
+        assert engine.normalize_meta_data({"duration": 7})["duration"] == 7
+
+
+def test_aspect_ratio_maps_to_declared_field():
+    for engine in routing.candidates(True, aspect_ratio="9:16"):
+        meta_data = routing.capability_meta_data(engine, None, "9:16")
+        assert set(meta_data) <= set(engine.meta_data_schema.model_fields)
+        assert meta_data
+
+
+def test_unconstrained_request_keeps_all_capable_engines():
+    assert "hailoutext" in names(routing.candidates(False))
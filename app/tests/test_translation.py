@@ -0,0 +1,11 @@
+from utils.ai import is_in_language
+
+
+def test_english_prompt_skips_translation():
+    assert is_in_language("a cat walking on the beach at sunset", "English")
+
+
+def test_ascii_non_english_prompts_are_translated():
+    assert not is_in_language("ye gorbe ke too sahel rah mire", "English")
+    assert not is_in_language("un chat marche sur la plage", "English")
+    assert not is_in_language("یک گربه در ساحل", "English")
@@ -1,7 +1,44 @@
+import hashlib
+import logging
 import os
+import unicodedata
 
+from fastapi_mongo_base.models import BaseEntity
+from langdetect import DetectorFactory, LangDetectException, detect_langs
 from fastapi_mongo_base.utils.basic import retry_execution, try_except_wrapper
-from usso.session import AsyncUssoSession
+from pymongo import ASCENDING, IndexModel
+from pymongo.errors import DuplicateKeyError
+from server import config
+
+from . import clients
+from .cache import TTLCache
+
+
+class TranslationCache(BaseEntity):
+    key: str
+    source_language: str
+    target_language: str
+    translated_text: str
+
+    class Settings:
+        indexes = BaseEntity.Settings.indexes + [
+            IndexModel([("key", ASCENDING)], unique=True),
+            IndexModel(
+                [("created_at", ASCENDING)],
+                expireAfterSeconds=config.Settings.translation_cache_ttl,
+            ),
+        ]
+
+
+# langdetect is randomized; pin it so a prompt always gets the same verdict.
+DetectorFactory.seed = 0
+
+LANGUAGE_CODES = {"English": "en", "Persian": "fa"}
+
+_translations: TTLCache[str, str] = TTLCache(
+    maxsize=config.Settings.translation_cache_size,
+    ttl=config.Settings.translation_cache_ttl,
+)
 
 
 @try_except_wrapper
@@ -9,15 +46,72 @@ from usso.session import AsyncUssoSession
 async def answer_with_ai(key, **kwargs) -> dict:
     kwargs["source_language"] = kwargs.get("lang", "Persian")
     kwargs["target_language"] = kwargs.get("target_language", "English")
-    async with AsyncUssoSession(
-        usso_refresh_url=os.getenv("USSO_REFRESH_URL"),
-        api_key=os.getenv("UFILES_API_KEY"),
-    ) as session:
-        response = await session.post(f'{os.getenv("PROMPTLY_URL")}/{key}', json=kwargs)
-        response.raise_for_status()
-        return response.json()
-
-
-async def translate(text: str) -> str:
-    resp: dict = await answer_with_ai("graphic_translate", text=text)
-    return resp.get("translated_text")
+    session = clients.get_usso_session()
+    response = await session.post(f'{os.getenv("PROMPTLY_URL")}/{key}', json=kwargs)
+    response.raise_for_status()
+    return response.json()
+
+
+def normalize_text(text: str) -> str:
+    return " ".join(unicodedata.normalize("NFKC", text).split())
+
+
+def is_in_language(text: str, language: str, threshold: float = 0.9) -> bool:
+    # Script alone is not enough: Finglish and other Latin-script languages
+    # are plain ASCII too, so only skip the round trip on a confident match.
+    code = LANGUAGE_CODES.get(language)
+    if code is None:
+        return False
+    try:
+        langs = detect_langs(text)
+    except LangDetectException:
+        # No letters to detect from (digits, punctuation, emoji).
+        return True
+    return langs[0].lang == code and langs[0].prob >= threshold
+
+
+def translation_key(text: str, source_language: str, target_language: str) -> str:
+    digest = hashlib.sha256(text.encode()).hexdigest()
+    return f"{source_language}:{target_language}:{digest}"
+
+
+async def translate(
+    text: str, source_language: str = "Persian", target_language: str = "English"
+) -> str:
+    text = normalize_text(text)
+    if is_in_language(text, target_language):
+        return text
+
+    key = translation_key(text, source_language, target_language)
+    translated = _translations.get(key)
+    if translated is not None:
+        return translated
+
+    cached = await TranslationCache.find_one({"key": key})
+    if cached is not None:
+        _translations.set(key, cached.translated_text)
+        return cached.translated_text
+
+    resp: dict = await answer_with_ai(
+        "graphic_translate",
+        text=text,
+        lang=source_language,
+        target_language=target_language,
+    )
+    translated = resp.get("translated_text")
+    if translated is None:
+        return None
+
+    _translations.set(key, translated)
+    try:
+        await TranslationCache(
+            key=key,
+            source_language=source_language,
+            target_language=target_language,
+            translated_text=translated,
+        ).insert()
+    except DuplicateKeyError:
+        pass
+    except Exception as e:
+        logging.error(f"Caching translation failed: {e}")
+    return translated
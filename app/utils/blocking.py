@@ -0,0 +1,134 @@
+import asyncio
+import functools
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from server.config import Settings
+
+_executor: ThreadPoolExecutor | None = None
+_slots: asyncio.Semaphore | None = None
+
+
+def get_executor() -> ThreadPoolExecutor:
+    global _executor, _slots
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=Settings.blocking_pool_size, thread_name_prefix="blocking"
+        )
+        _slots = asyncio.Semaphore(Settings.blocking_pool_size)
+    return _executor
+
+
+async def run_blocking(func, *args, timeout: float | None = None, **kwargs):
+    # For SDK calls that have no async variant. Calls wait for a free thread
+    # here rather than in the executor queue, so a cancelled or timed out call
+    # that has not started never runs; one that has started runs to completion
+    # in its thread and its result is dropped.
+    executor = get_executor()
+    timeout = timeout or Settings.blocking_timeout
+    loop = asyncio.get_running_loop()
+
+    async def call():
+        async with _slots:
+            return await loop.run_in_executor(
+                executor, functools.partial(func, *args, **kwargs)
+            )
+
+    try:
+        return await asyncio.wait_for(call(), timeout)
+    except asyncio.TimeoutError:
+        raise TimeoutError(
+            f"{getattr(func, '__qualname__', func)} did not finish in {timeout}s"
+        )
+
+
+def shutdown():
+    global _executor, _slots
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+    _executor = _slots = None
+
+
+def _app_frame(frame) -> str | None:
+    # The innermost frame of our own code, as Class.method when it is one.
+    app_dir = str(Settings.base_dir)
+    summary = None
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if filename.startswith(app_dir) and os.sep + "site-packages" not in filename:
+            instance = frame.f_locals.get("self")
+            name = frame.f_code.co_name
+            if instance is not None:
+                name = f"{type(instance).__name__}.{name}"
+            summary = f"{name} ({os.path.basename(filename)}:{frame.f_lineno})"
+            break
+        frame = frame.f_back
+    return summary
+
+
+class StallMonitor:
+    # Debug aid: a watchdog thread reports when the event loop has not run a
+    # heartbeat for longer than the threshold, with the code holding it.
+
+    def __init__(self, threshold: float):
+        self.threshold = threshold
+        self.last_beat = time.monotonic()
+        self.loop_thread_id = threading.get_ident()
+        self._stopped = threading.Event()
+        self._heartbeat: asyncio.Task | None = None
+        self._watchdog = threading.Thread(
+            target=self._watch, name="stall-monitor", daemon=True
+        )
+
+    def start(self):
+        self._heartbeat = asyncio.create_task(self._beat())
+        self._watchdog.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._heartbeat:
+            self._heartbeat.cancel()
+
+    async def _beat(self):
+        while True:
+            self.last_beat = time.monotonic()
+            await asyncio.sleep(self.threshold / 4)
+
+    def _watch(self):
+        reported = None
+        while not self._stopped.wait(self.threshold / 4):
+            beat = self.last_beat
+            stalled = time.monotonic() - beat
+            if stalled < self.threshold or beat == reported:
+                continue
+            reported = beat
+            frame = sys._current_frames().get(self.loop_thread_id)
+            stack = "".join(traceback.format_stack(frame, limit=8)) if frame else ""
+            where = _app_frame(frame) if frame else None
+            logging.warning(
+                f"Event loop stalled for {stalled * 1000:.0f}ms in "
+                f"{where or 'unknown'}\n{stack}"
+            )
+
+
+_monitor: StallMonitor | None = None
+
+
+def start_stall_monitor():
+    global _monitor
+    if Settings.loop_stall_threshold <= 0 or _monitor is not None:
+        return
+    _monitor = StallMonitor(Settings.loop_stall_threshold / 1000)
+    _monitor.start()
+
+
+def stop_stall_monitor():
+    global _monitor
+    if _monitor is not None:
+        _monitor.stop()
+        _monitor = None
@@ -0,0 +1,106 @@
+import importlib.util
+import os
+
+import httpx
+from server.config import Settings
+
+_clients: dict[str, object] = {}
+
+
+def _limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=Settings.http_max_connections,
+        max_keepalive_connections=Settings.http_max_keepalive_connections,
+        keepalive_expiry=Settings.http_keepalive_expiry,
+    )
+
+
+def _http2() -> bool:
+    return importlib.util.find_spec("h2") is not None
+
+
+def new_http_client(**kwargs) -> httpx.AsyncClient:
+    return httpx.AsyncClient(limits=_limits(), http2=_http2(), **kwargs)
+
+
+def _pooled(client):
+    # The SDK clients subclass httpx.AsyncClient but initialize it without
+    # arguments, so the tuned transport is swapped in before first use.
+    if isinstance(client, httpx.AsyncClient):
+        client._transport = httpx.AsyncHTTPTransport(limits=_limits(), http2=_http2())
+    return client
+
+
+def get_http_client(upstream: str) -> httpx.AsyncClient:
+    # Plain HTTP calls get one client, and so one pool, per upstream:
+    # "media" for stored files, "downloads" for provider results and
+    # "ffmpeg" for the ufiles ffmpeg app.
+    name = f"http:{upstream}"
+    if name not in _clients:
+        _clients[name] = new_http_client()
+    return _clients[name]
+
+
+def get_runway_client():
+    from runwayml import AsyncRunwayML
+
+    if "runway" not in _clients:
+        _clients["runway"] = AsyncRunwayML(
+            api_key=os.getenv("RUNWAY_API_KEY"), http_client=new_http_client()
+        )
+    return _clients["runway"]
+
+
+def get_ufiles_client():
+    import ufiles
+
+    if "ufiles" not in _clients:
+        _clients["ufiles"] = _pooled(
+            ufiles.AsyncUFiles(
+                ufiles_base_url=Settings.UFILES_BASE_URL,
+                usso_base_url=Settings.USSO_BASE_URL,
+                api_key=Settings.UFILES_API_KEY,
+            )
+        )
+    return _clients["ufiles"]
+
+
+def get_ufaas_client():
+    from ufaas import AsyncUFaaS
+
+    if "ufaas" not in _clients:
+        _clients["ufaas"] = _pooled(
+            AsyncUFaaS(
+                ufaas_base_url=Settings.UFAAS_BASE_URL,
+                usso_base_url=Settings.USSO_BASE_URL,
+                api_key=Settings.UFILES_API_KEY,
+            )
+        )
+    return _clients["ufaas"]
+
+
+def get_usso_session():
+    from usso.session import AsyncUssoSession
+
+    if "usso" not in _clients:
+        _clients["usso"] = _pooled(
+            AsyncUssoSession(
+                usso_refresh_url=os.getenv("USSO_REFRESH_URL"),
+                api_key=os.getenv("UFILES_API_KEY"),
+            )
+        )
+    return _clients["usso"]
+
+
+async def close_clients():
+    import logging
+
+    while _clients:
+        name, client = _clients.popitem()
+        close = getattr(client, "aclose", None) or getattr(client, "close", None)
+        if close is None:
+            continue
+        try:
+            await close()
+        except Exception as e:
+            logging.error(f"Closing {name} client failed: {e}")
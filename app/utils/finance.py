@@ -1,29 +1,72 @@
+import asyncio
+import logging
 import uuid
 from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
 from decimal import Decimal
+from enum import Enum
 from typing import AsyncGenerator
 
-from aiocache import cached
-from fastapi_mongo_base.utils import basic
+from beanie import UpdateResponse
+from fastapi_mongo_base.models import BaseEntity
+from pymongo import ASCENDING, IndexModel
+from pymongo.errors import DuplicateKeyError
+from server import config
 from server.config import Settings
 from ufaas import AsyncUFaaS, exceptions
 from ufaas.apps.saas.schemas import UsageCreateSchema, UsageSchema
 
+from . import clients, metrics
+
 resource_variant = getattr(Settings, "UFAAS_RESOURCE_VARIANT", "videogen")
 
 
+class ReservationStatus(str, Enum):
+    pending = "pending"
+    metering = "metering"
+    metered = "metered"
+    cancelled = "cancelled"
+    refunded = "refunded"
+
+
+class CoinBalance(BaseEntity):
+    # Last quota read from UFaaS, minus coins reserved here but not yet metered.
+    user_id: uuid.UUID
+    quota: float = 0
+    reserved: float = 0
+    synced_at: datetime | None = None
+    # Bumped around every meter; a sync only applies if it did not change.
+    metered_seq: int = 0
+
+    class Settings:
+        indexes = BaseEntity.Settings.indexes + [
+            IndexModel([("user_id", ASCENDING)], unique=True),
+        ]
+
+
+class CoinReservation(BaseEntity):
+    user_id: uuid.UUID
+    video_uid: uuid.UUID
+    amount: float
+    status: ReservationStatus = ReservationStatus.pending
+    cancel_requested: bool = False
+    usage_id: uuid.UUID | None = None
+    lease_until: datetime | None = None
+
+    class Settings:
+        indexes = BaseEntity.Settings.indexes + [
+            IndexModel([("video_uid", ASCENDING)]),
+            IndexModel([("status", ASCENDING), ("lease_until", ASCENDING)]),
+        ]
+
+
+_balance_syncs: dict[uuid.UUID, asyncio.Task] = {}
+
+
 @asynccontextmanager
 async def get_ufaas_client() -> AsyncGenerator[AsyncUFaaS, None]:
-    client = AsyncUFaaS(
-        ufaas_base_url=Settings.UFAAS_BASE_URL,
-        usso_base_url=Settings.USSO_BASE_URL,
-        api_key=Settings.UFILES_API_KEY,
-    )
-    try:
-        yield client
-    finally:
-        # Add cleanup here if needed in the future
-        pass
+    # The client is shared for the app's lifetime and closed on shutdown.
+    yield clients.get_ufaas_client()
 
 
 async def meter_cost(
@@ -43,9 +86,23 @@ async def meter_cost(
         return usage
 
 
-@basic.try_except_wrapper
-@cached(ttl=5)
-async def get_quota(user_id: uuid.UUID) -> Decimal:
+async def find_usage(reservation: CoinReservation) -> UsageSchema | None:
+    # The usage metered for a reservation, if a previous attempt got that far.
+    async with get_ufaas_client() as ufaas_client:
+        usages = await ufaas_client.saas.usages.list_items(
+            user_id=reservation.user_id,
+            variant=resource_variant,
+            created_at_from=reservation.created_at,
+            limit=100,
+            timeout=30,
+        )
+    for usage in usages.items:
+        if (usage.meta_data or {}).get("reservation") == str(reservation.uid):
+            return usage
+    return None
+
+
+async def fetch_quota(user_id: uuid.UUID) -> Decimal:
     async with get_ufaas_client() as ufaas_client:
         quotas = await ufaas_client.saas.enrollments.get_quotas(
             user_id=user_id,
@@ -56,7 +113,6 @@ async def get_quota(user_id: uuid.UUID) -> Decimal:
     return quotas.quota
 
 
-@basic.try_except_wrapper
 async def cancel_usage(usage_id: uuid.UUID) -> None:
     if usage_id is None:
         return
@@ -64,10 +120,232 @@ async def cancel_usage(usage_id: uuid.UUID) -> None:
         await ufaas_client.saas.usages.cancel_item(usage_id)
 
 
-async def check_quota(user_id: uuid.UUID, coin: float) -> Decimal:
-    quota = await get_quota(user_id)
-    if quota is None or quota < coin:
+async def sync_balance(user_id: uuid.UUID) -> CoinBalance | None:
+    balance = await CoinBalance.find_one({"user_id": user_id})
+    metered_seq = balance.metered_seq if balance else 0
+    try:
+        # Read after metered_seq, so a meter in between is detected.
+        quota = await fetch_quota(user_id)
+    except Exception as e:
+        logging.error(f"Syncing the balance of {user_id} failed: {e}")
+        return balance
+    if quota is None:
+        return balance
+
+    now = datetime.now()
+    try:
+        # A meter since the read may or may not be in `quota`, so the stale
+        # value is dropped rather than double counted or lost.
+        synced = await CoinBalance.find_one(
+            {"user_id": user_id, "metered_seq": metered_seq}
+        ).upsert(
+            {"$set": {"quota": float(quota), "synced_at": now}},
+            on_insert=CoinBalance(user_id=user_id, quota=float(quota), synced_at=now),
+            response_type=UpdateResponse.NEW_DOCUMENT,
+        )
+    except DuplicateKeyError:
+        synced = None
+    return synced or await CoinBalance.find_one({"user_id": user_id})
+
+
+def _refresh_balance(user_id: uuid.UUID):
+    if user_id in _balance_syncs:
+        return
+    task = asyncio.create_task(sync_balance(user_id))
+    _balance_syncs[user_id] = task
+    task.add_done_callback(lambda _: _balance_syncs.pop(user_id, None))
+
+
+async def reserve_coins(
+    user_id: uuid.UUID, amount: float, video_uid: uuid.UUID
+) -> CoinReservation:
+    (reservation,) = await reserve_coins_batch(user_id, {video_uid: amount})
+    return reservation
+
+
+async def reserve_coins_batch(
+    user_id: uuid.UUID, amounts: dict[uuid.UUID, float]
+) -> list[CoinReservation]:
+    # Reserves against the locally mirrored balance, so creating videos does
+    # not wait on UFaaS; usage is metered later by reconcile_reservations.
+    # The whole batch is reserved at once or not at all.
+    amount = sum(amounts.values())
+    balance = await CoinBalance.find_one({"user_id": user_id})
+    if balance is None:
+        balance = await sync_balance(user_id)
+    elif balance.synced_at is None or balance.synced_at < datetime.now() - timedelta(
+        seconds=config.Settings.quota_sync_interval
+    ):
+        _refresh_balance(user_id)
+
+    if balance is not None:
+        balance = await CoinBalance.find_one(
+            {
+                "user_id": user_id,
+                "$expr": {"$gte": [{"$subtract": ["$quota", "$reserved"]}, amount]},
+            }
+        ).update(
+            {"$inc": {"reserved": amount}},
+            response_type=UpdateResponse.NEW_DOCUMENT,
+        )
+    if balance is None:
+        available = await CoinBalance.find_one({"user_id": user_id})
+        available = available.quota - available.reserved if available else None
         raise exceptions.InsufficientFunds(
-            f"You have only {quota} coins, while you need {coin} coins."
+            f"You have only {available} coins, while you need {amount} coins."
+        )
+
+    reservations = [
+        CoinReservation(user_id=user_id, video_uid=video_uid, amount=video_amount)
+        for video_uid, video_amount in amounts.items()
+    ]
+    await CoinReservation.insert_many(reservations)
+    return reservations
+
+
+async def release_reservation(video_uid: uuid.UUID) -> bool:
+    # Unmetered reservations are dropped locally; metered ones are refunded by
+    # the reconciler. False if the video has no reservation at all.
+    reservation = await CoinReservation.find_one(
+        {"video_uid": video_uid, "status": ReservationStatus.pending}
+    ).update(
+        {"$set": {"status": ReservationStatus.cancelled}},
+        response_type=UpdateResponse.NEW_DOCUMENT,
+    )
+    if reservation is not None:
+        await CoinBalance.find_one({"user_id": reservation.user_id}).update(
+            {"$inc": {"reserved": -reservation.amount}}
+        )
+        metrics.REFUNDS.labels("released").inc()
+        return True
+
+    marked = await CoinReservation.find(
+        {
+            "video_uid": video_uid,
+            "status": {
+                "$in": [ReservationStatus.metering, ReservationStatus.metered]
+            },
+        }
+    ).update_many({"$set": {"cancel_requested": True}})
+    if marked.matched_count:
+        return True
+    return await CoinReservation.find_one({"video_uid": video_uid}) is not None
+
+
+async def _claim_reservation() -> CoinReservation | None:
+    now = datetime.now()
+    lease_until = now + timedelta(seconds=config.Settings.lease_duration)
+    return await CoinReservation.find_one(
+        {
+            "$or": [
+                {"status": ReservationStatus.pending},
+                {
+                    "status": ReservationStatus.metered,
+                    "cancel_requested": True,
+                },
+                # Metering interrupted by a crash.
+                {"status": ReservationStatus.metering},
+            ],
+            "lease_until": {"$not": {"$gte": now}},
+        }
+    ).update(
+        {"$set": {"lease_until": lease_until}},
+        response_type=UpdateResponse.NEW_DOCUMENT,
+    )
+
+
+async def _reconcile(reservation: CoinReservation) -> tuple[uuid.UUID, uuid.UUID] | None:
+    collection = CoinReservation.get_motor_collection()
+    if reservation.status == ReservationStatus.metered:
+        # Raises on failure; the reservation stays metered and is retried
+        # once its lease expires.
+        await cancel_usage(reservation.usage_id)
+        await collection.update_one(
+            {"_id": reservation.id},
+            {"$set": {"status": ReservationStatus.refunded.value}},
+        )
+        metrics.REFUNDS.labels("refunded").inc()
+        return None
+
+    claimed = await collection.update_one(
+        {
+            "_id": reservation.id,
+            "status": {
+                "$in": [
+                    ReservationStatus.pending.value,
+                    ReservationStatus.metering.value,
+                ]
+            },
+        },
+        {"$set": {"status": ReservationStatus.metering.value}},
+    )
+    if not claimed.matched_count:
+        # Cancelled while it was being claimed.
+        return None
+    await CoinBalance.find_one({"user_id": reservation.user_id}).update(
+        {"$inc": {"metered_seq": 1}}
+    )
+
+    usage = None
+    if reservation.status == ReservationStatus.metering:
+        # An earlier attempt was interrupted and may have metered already.
+        usage = await find_usage(reservation)
+    if usage is None:
+        usage = await meter_cost(
+            reservation.user_id,
+            reservation.amount,
+            meta_data={"reservation": str(reservation.uid)},
         )
-    return quota
+    reservation = await CoinReservation.find_one({"_id": reservation.id}).update(
+        {
+            "$set": {
+                "status": ReservationStatus.metered,
+                "usage_id": usage.uid,
+                "lease_until": None,
+            }
+        },
+        response_type=UpdateResponse.NEW_DOCUMENT,
+    )
+    # The remote quota now includes this usage, so it moves from `reserved`
+    # to the mirrored quota until the next sync. Done after the status so a
+    # crash in between leaves coins reserved rather than released twice.
+    await CoinBalance.find_one({"user_id": reservation.user_id}).update(
+        {
+            "$inc": {
+                "reserved": -reservation.amount,
+                "quota": -reservation.amount,
+                "metered_seq": 1,
+            }
+        }
+    )
+    if reservation.cancel_requested:
+        await _reconcile(reservation)
+    return reservation.video_uid, usage.uid
+
+
+async def reconcile_reservations() -> list[tuple[uuid.UUID, uuid.UUID]]:
+    # Meters pending reservations and refunds cancelled ones with UFaaS, and
+    # returns the (video_uid, usage_id) pairs metered in this run.
+    semaphore = asyncio.Semaphore(config.Settings.billing_concurrency)
+    metered: list[tuple[uuid.UUID, uuid.UUID]] = []
+
+    async def reconcile(reservation: CoinReservation):
+        try:
+            if result := await _reconcile(reservation):
+                metered.append(result)
+        except Exception as e:
+            logging.error(f"Reconciling reservation {reservation.uid} failed: {e}")
+        finally:
+            semaphore.release()
+
+    tasks = []
+    for _ in range(config.Settings.billing_batch_size):
+        await semaphore.acquire()
+        reservation = await _claim_reservation()
+        if reservation is None:
+            semaphore.release()
+            break
+        tasks.append(asyncio.create_task(reconcile(reservation)))
+
+    await asyncio.gather(*tasks)
+    return metered
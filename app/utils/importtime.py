@@ -0,0 +1,75 @@
+import importlib.abc
+import logging
+import sys
+import time
+
+# module -> (cumulative seconds, self seconds)
+durations: dict[str, tuple[float, float]] = {}
+_children: list[float] = []
+
+
+class _TimedLoader(importlib.abc.Loader):
+    def __init__(self, loader):
+        self.loader = loader
+
+    def create_module(self, spec):
+        return self.loader.create_module(spec)
+
+    def exec_module(self, module):
+        # The module keeps its real loader; only its execution is timed.
+        module.__loader__ = self.loader
+        if module.__spec__ is not None:
+            module.__spec__.loader = self.loader
+
+        _children.append(0.0)
+        started = time.perf_counter()
+        try:
+            self.loader.exec_module(module)
+        finally:
+            elapsed = time.perf_counter() - started
+            nested = _children.pop()
+            if _children:
+                _children[-1] += elapsed
+            durations[module.__name__] = (elapsed, elapsed - nested)
+
+
+class ImportTimer(importlib.abc.MetaPathFinder):
+    def find_spec(self, fullname, path, target=None):
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, "find_spec"):
+                continue
+            spec = finder.find_spec(fullname, path, target)
+            if spec is not None:
+                break
+        else:
+            return None
+        if spec.loader is None or not hasattr(spec.loader, "exec_module"):
+            return spec
+        spec.loader = _TimedLoader(spec.loader)
+        return spec
+
+
+_timer = ImportTimer()
+
+
+def install():
+    if _timer not in sys.meta_path:
+        sys.meta_path.insert(0, _timer)
+
+
+def report(limit: int = 20):
+    # Logged once at startup; imports after that are no longer timed.
+    if _timer in sys.meta_path:
+        sys.meta_path.remove(_timer)
+    if not durations:
+        return
+    top = sorted(durations.items(), key=lambda item: item[1][1], reverse=True)
+    total = sum(self_time for _, self_time in durations.values())
+    lines = [
+        f"{self_time * 1000:8.1f}ms {cumulative * 1000:8.1f}ms  {name}"
+        for name, (cumulative, self_time) in top[:limit]
+    ]
+    logging.info(
+        f"Imported {len(durations)} modules in {total * 1000:.0f}ms "
+        f"(self, cumulative):\n" + "\n".join(lines)
+    )
@@ -1,3 +1,4 @@
+import hashlib
 import json
 import uuid
 from io import BytesIO
@@ -5,6 +6,8 @@ from io import BytesIO
 import ufiles
 from server.config import Settings
 
+from . import clients, mp4
+
 
 async def upload_ufile(
     file_bytes: BytesIO,
@@ -12,11 +15,7 @@ async def upload_ufile(
     meta_data: dict | None = None,
     file_upload_dir: str = "videogens",
 ):
-    client = ufiles.AsyncUFiles(
-        ufiles_base_url=Settings.UFILES_BASE_URL,
-        usso_base_url=Settings.USSO_BASE_URL,
-        api_key=Settings.UFILES_API_KEY,
-    )
+    client = clients.get_ufiles_client()
 
     return await client.upload_bytes(
         file_bytes,
@@ -35,11 +34,7 @@ async def upload_url(
     meta_data: dict | None = None,
     file_upload_dir: str = "videogens",
 ):
-    client = ufiles.AsyncUFiles(
-        ufiles_base_url=Settings.UFILES_BASE_URL,
-        usso_base_url=Settings.USSO_BASE_URL,
-        api_key=Settings.UFILES_API_KEY,
-    )
+    client = clients.get_ufiles_client()
 
     return await client.upload_url(
         url,
@@ -49,3 +44,72 @@ async def upload_url(
         meta_data=meta_data,
         timeout=None,
     )
+
+
+class RelayResult:
+    def __init__(self):
+        self.file: ufiles.UFileItem | None = None
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+        self.scanner = mp4.MP4Scanner()
+
+    @property
+    def metadata(self) -> dict | None:
+        return self.scanner.metadata
+
+
+async def relay_url(
+    url: str,
+    user_id: uuid.UUID,
+    filename: str,
+    meta_data: dict | None = None,
+    file_upload_dir: str = "videogens",
+) -> RelayResult:
+    # Streams the provider's file into ufiles chunk by chunk, so memory stays
+    # at one chunk (plus the moov box) whatever the file size; the checksum
+    # and MP4 metadata are computed in the same pass.
+    client = clients.get_ufiles_client()
+    result = RelayResult()
+    boundary = uuid.uuid4().hex
+    fields = {
+        "filename": f"{file_upload_dir}/{filename}",
+        "public_permission": json.dumps({"permission": ufiles.PermissionEnum.READ}),
+        "user_id": str(user_id),
+        "meta_data": json.dumps(meta_data) if meta_data else None,
+    }
+
+    async def body():
+        for name, value in fields.items():
+            if value is None:
+                continue
+            yield (
+                f"--{boundary}\r\n"
+                f'Content-Disposition: form-data; name="{name}"\r\n\r\n'
+                f"{value}\r\n"
+            ).encode()
+        yield (
+            f"--{boundary}\r\n"
+            f'Content-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+            "Content-Type: video/mp4\r\n\r\n"
+        ).encode()
+
+        async with clients.get_http_client("downloads").stream("GET", url) as response:
+            response.raise_for_status()
+            async for chunk in response.aiter_bytes(Settings.relay_chunk_size):
+                result.sha256.update(chunk)
+                result.size += len(chunk)
+                if not result.scanner.done:
+                    result.scanner.feed(chunk)
+                yield chunk
+
+        yield f"\r\n--{boundary}--\r\n".encode()
+
+    response = await client.post(
+        client.upload_file_url,
+        headers={"Content-Type": f"multipart/form-data; boundary={boundary}"},
+        content=body(),
+        timeout=None,
+    )
+    response.raise_for_status()
+    result.file = ufiles.UFileItem(**response.json())
+    return result
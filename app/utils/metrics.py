@@ -0,0 +1,69 @@
+import functools
+import time
+
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram
+from prometheus_client import generate_latest
+
+ENGINE_CALL_SECONDS = Histogram(
+    "videogen_engine_call_seconds",
+    "Duration of engine provider calls",
+    ["engine", "method", "outcome"],
+)
+UPDATE_CYCLE_SECONDS = Histogram(
+    "videogen_update_cycle_seconds",
+    "Duration of an update_video cycle",
+    buckets=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300),
+)
+UPDATE_CYCLE_ITEMS = Histogram(
+    "videogen_update_cycle_items",
+    "Videos polled in an update_video cycle",
+    buckets=(0, 1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500),
+)
+STEP_SECONDS = Histogram(
+    "videogen_step_seconds",
+    "Duration of pipeline steps",
+    ["step"],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300),
+)
+VIDEOS_IN_FLIGHT = Gauge(
+    "videogen_videos_in_flight",
+    "Videos that are not done, by status",
+    ["status"],
+)
+RETRIES = Counter(
+    "videogen_retries_total",
+    "Video resubmissions scheduled",
+    ["reason"],
+)
+REFUNDS = Counter(
+    "videogen_refunds_total",
+    "Coin reservations given back",
+    ["kind"],
+)
+UNKNOWN_ENGINE_STATUS = Counter(
+    "videogen_unknown_engine_status_total",
+    "Provider statuses that fell back to error",
+    ["status"],
+)
+
+
+def observe_engine(method):
+    @functools.wraps(method)
+    async def wrapper(self, *args, **kwargs):
+        outcome = "ok"
+        started = time.perf_counter()
+        try:
+            return await method(self, *args, **kwargs)
+        except Exception:
+            outcome = "error"
+            raise
+        finally:
+            ENGINE_CALL_SECONDS.labels(
+                self.get_class_name(), method.__name__, outcome
+            ).observe(time.perf_counter() - started)
+
+    return wrapper
+
+
+def render() -> tuple[bytes, str]:
+    return generate_latest(), CONTENT_TYPE_LATEST
@@ -0,0 +1,188 @@
+import logging
+import struct
+
+import httpx
+
+from . import clients
+
+HEAD_SIZE = 64 * 1024
+MAX_MOOV_SIZE = 16 * 1024 * 1024
+
+
+def read_box_header(data: bytes, offset: int) -> tuple[int, str, int] | None:
+    """Return (size, type, header_size) of the box at `offset`, if readable."""
+    if offset + 8 > len(data):
+        return None
+    size, box_type = struct.unpack_from(">I4s", data, offset)
+    header_size = 8
+    if size == 1:
+        if offset + 16 > len(data):
+            return None
+        (size,) = struct.unpack_from(">Q", data, offset + 8)
+        header_size = 16
+    return size, box_type.decode("latin-1"), header_size
+
+
+def iter_boxes(data: bytes, start: int = 0, end: int | None = None):
+    end = len(data) if end is None else end
+    offset = start
+    while offset < end:
+        header = read_box_header(data, offset)
+        if header is None:
+            return
+        size, box_type, header_size = header
+        if size == 0:
+            size = end - offset
+        if size < header_size:
+            return
+        yield box_type, offset + header_size, min(offset + size, end)
+        offset += size
+
+
+def _parse_mvhd(data: bytes, start: int) -> float | None:
+    version = data[start]
+    if version == 1:
+        timescale, duration = struct.unpack_from(">IQ", data, start + 20)
+    else:
+        timescale, duration = struct.unpack_from(">II", data, start + 12)
+    if not timescale:
+        return None
+    return duration / timescale
+
+
+def _parse_tkhd(data: bytes, start: int) -> tuple[int, int]:
+    version = data[start]
+    # version/flags, times, track id, reserved and duration, then reserved,
+    # layer, alternate group, volume, reserved and the 3x3 matrix.
+    matrix_offset = start + (4 + 32 if version == 1 else 4 + 20) + 16
+    a, b = struct.unpack_from(">ii", data, matrix_offset)
+    width, height = struct.unpack_from(">II", data, matrix_offset + 36)
+    width, height = width >> 16, height >> 16
+    if a == 0 and abs(b) == 1 << 16:
+        # Rotated by 90 or 270 degrees.
+        width, height = height, width
+    return width, height
+
+
+def parse_moov(data: bytes, start: int = 0, end: int | None = None) -> dict | None:
+    """Read duration and video dimensions from the payload of a `moov` box."""
+    duration = None
+    width = height = 0
+    for box_type, box_start, box_end in iter_boxes(data, start, end):
+        if box_type == "mvhd":
+            duration = _parse_mvhd(data, box_start)
+        elif box_type == "trak" and not width:
+            for child_type, child_start, _ in iter_boxes(data, box_start, box_end):
+                if child_type == "tkhd":
+                    width, height = _parse_tkhd(data, child_start)
+    if duration is None or not width or not height:
+        return None
+    return {"width": width, "height": height, "duration": duration}
+
+
+class MP4Scanner:
+    """Incrementally finds `moov` in a sequential stream and parses it.
+
+    Only the `moov` box is buffered; every other box is skipped as it passes.
+    """
+
+    def __init__(self, max_moov_size: int = MAX_MOOV_SIZE):
+        self.max_moov_size = max_moov_size
+        self.metadata: dict | None = None
+        self.done = False
+        self._buffer = bytearray()
+        self._skip = 0
+        self._moov: tuple[int, int] | None = None
+
+    def feed(self, chunk: bytes):
+        view = memoryview(chunk)
+        while view and not self.done:
+            if self._skip:
+                taken = min(self._skip, len(view))
+                self._skip -= taken
+                view = view[taken:]
+                continue
+
+            if self._moov is not None:
+                size, header_size = self._moov
+                taken = size - len(self._buffer)
+                self._buffer += view[:taken]
+                view = view[taken:]
+                if len(self._buffer) == size:
+                    self.metadata = parse_moov(bytes(self._buffer), header_size, size)
+                    self._buffer.clear()
+                    self.done = True
+                continue
+
+            # Read a box header: 8 bytes, or 16 when it carries a 64-bit size.
+            target = 8
+            if len(self._buffer) >= 8 and self._buffer[:4] == b"\0\0\0\1":
+                target = 16
+            taken = target - len(self._buffer)
+            self._buffer += view[:taken]
+            view = view[taken:]
+            header = read_box_header(self._buffer, 0)
+            if header is None:
+                continue
+            size, box_type, header_size = header
+            if size == 0 or size < header_size:
+                self.done = True
+            elif box_type == "moov":
+                if size > self.max_moov_size:
+                    self.done = True
+                self._moov = (size, header_size)
+            else:
+                self._skip = size - len(self._buffer)
+                self._buffer.clear()
+
+
+async def _fetch_range(client: httpx.AsyncClient, url: str, start: int, size: int):
+    # Reads at most `size` bytes even when the server ignores the Range header.
+    headers = {"Range": f"bytes={start}-{start + size - 1}"}
+    async with client.stream("GET", url, headers=headers) as response:
+        response.raise_for_status()
+        if start and response.status_code != 206:
+            raise ValueError("Range requests are not supported")
+        total = None
+        content_range = response.headers.get("content-range", "")
+        if "/" in content_range and not content_range.endswith("*"):
+            total = int(content_range.rsplit("/", 1)[1])
+        chunks = bytearray()
+        async for chunk in response.aiter_bytes():
+            chunks += chunk
+            if len(chunks) >= size:
+                break
+    return bytes(chunks[:size]), total
+
+
+async def probe(url: str) -> dict | None:
+    """Fetch only the ISO-BMFF headers of `url` and read its metadata."""
+    client = clients.get_http_client("media")
+    try:
+        offset = 0
+        data, total = await _fetch_range(client, url, 0, HEAD_SIZE)
+        while True:
+            header = read_box_header(data, 0)
+            if header is None:
+                return None
+            size, box_type, header_size = header
+            if box_type == "moov":
+                if size > MAX_MOOV_SIZE:
+                    return None
+                if size > len(data):
+                    data, _ = await _fetch_range(client, url, offset, size)
+                return parse_moov(data, header_size, size)
+            if size == 0 or size < header_size:
+                return None
+
+            # Skip the box; `moov` may sit after `mdat` at the end of the file.
+            offset += size
+            if total is not None and offset >= total:
+                return None
+            if size + 16 <= len(data):
+                data = data[size:]
+            else:
+                data, total = await _fetch_range(client, url, offset, HEAD_SIZE)
+    except Exception as e:
+        logging.warning(f"mp4 probe failed for {url}: {e}")
+        return None
@@ -0,0 +1,121 @@
+import asyncio
+import contextlib
+import json
+import logging
+from collections import defaultdict
+from typing import AsyncIterator
+
+from server.config import Settings
+
+
+class Subscription:
+    def __init__(self, maxsize: int):
+        self.queue: asyncio.Queue[dict] = asyncio.Queue(maxsize)
+
+    def put(self, message: dict):
+        # A slow reader loses its oldest events rather than blocking publishers.
+        if self.queue.full():
+            self.queue.get_nowait()
+        self.queue.put_nowait(message)
+
+    async def get(self, timeout: float) -> dict | None:
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+class Broker:
+    async def publish(self, channel: str, message: dict):
+        raise NotImplementedError
+
+    def subscribe(self, *channels: str) -> contextlib.AbstractAsyncContextManager:
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+
+class MemoryBroker(Broker):
+    # Only reaches subscribers of this process.
+
+    def __init__(self):
+        self._subscriptions: dict[str, set[Subscription]] = defaultdict(set)
+
+    async def publish(self, channel: str, message: dict):
+        for subscription in list(self._subscriptions.get(channel, ())):
+            subscription.put(message)
+
+    @contextlib.asynccontextmanager
+    async def subscribe(self, *channels: str) -> AsyncIterator[Subscription]:
+        subscription = Subscription(Settings.stream_queue_size)
+        for channel in channels:
+            self._subscriptions[channel].add(subscription)
+        try:
+            yield subscription
+        finally:
+            for channel in channels:
+                self._subscriptions[channel].discard(subscription)
+                if not self._subscriptions[channel]:
+                    del self._subscriptions[channel]
+
+
+class RedisBroker(Broker):
+    # Fans events out across replicas through Redis pub/sub.
+
+    def __init__(self, url: str):
+        from redis import asyncio as aioredis
+
+        self.redis = aioredis.from_url(url)
+
+    async def publish(self, channel: str, message: dict):
+        await self.redis.publish(channel, json.dumps(message))
+
+    @contextlib.asynccontextmanager
+    async def subscribe(self, *channels: str) -> AsyncIterator[Subscription]:
+        subscription = Subscription(Settings.stream_queue_size)
+        pubsub = self.redis.pubsub()
+        await pubsub.subscribe(*channels)
+
+        async def reader():
+            async for message in pubsub.listen():
+                if message["type"] == "message":
+                    subscription.put(json.loads(message["data"]))
+
+        task = asyncio.create_task(reader())
+        try:
+            yield subscription
+        finally:
+            task.cancel()
+            await pubsub.unsubscribe(*channels)
+            await pubsub.aclose()
+
+    async def close(self):
+        await self.redis.aclose()
+
+
+_broker: Broker | None = None
+
+
+def get_broker() -> Broker:
+    global _broker
+    if _broker is None:
+        if Settings.pubsub_redis_url:
+            _broker = RedisBroker(Settings.pubsub_redis_url)
+        else:
+            _broker = MemoryBroker()
+    return _broker
+
+
+async def publish(channel: str, message: dict):
+    try:
+        await get_broker().publish(channel, message)
+    except Exception as e:
+        logging.error(f"Failed to publish to {channel}: {e}")
+
+
+async def close_broker():
+    global _broker
+    if _broker is not None:
+        await _broker.close()
+        _broker = None
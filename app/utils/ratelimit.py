@@ -0,0 +1,101 @@
+import asyncio
+import logging
+import time
+from email.utils import parsedate_to_datetime
+
+from server.config import Settings
+
+
+def error_status_code(error: Exception) -> int | None:
+    status_code = (
+        getattr(error, "status_code", None)
+        or getattr(getattr(error, "response", None), "status_code", None)
+        or getattr(error, "status", None)
+    )
+    return status_code if isinstance(status_code, int) else None
+
+
+def is_rate_limited(error: Exception) -> bool:
+    return error_status_code(error) == 429
+
+
+def retry_after(error: Exception) -> float | None:
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+class RateLimiter:
+    # Token bucket (`rate` per second, up to `burst`) plus a cap on calls in
+    # flight. A 429 raised inside the block pauses the bucket for Retry-After.
+
+    def __init__(self, name: str, rate: float, burst: int, concurrency: int):
+        self.name = name
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = float(self.burst)
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._lock = asyncio.Lock()
+
+    def throttle(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    async def _take_token(self):
+        if self.rate <= 0:
+            return
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(
+                    self.burst, self.tokens + (now - self.updated_at) * self.rate
+                )
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    async def __aenter__(self):
+        await self._semaphore.acquire()
+        try:
+            await self._take_token()
+        except BaseException:
+            self._semaphore.release()
+            raise
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self._semaphore.release()
+        if exc is not None and is_rate_limited(exc):
+            delay = retry_after(exc) or Settings.poll_min_interval
+            logging.warning(f"{self.name} rate limited, pausing for {delay}s")
+            self.throttle(delay)
+        return False
+
+
+_limiters: dict[str, RateLimiter] = {}
+
+
+def get_limiter(provider: str) -> RateLimiter:
+    if provider not in _limiters:
+        _limiters[provider] = RateLimiter(
+            provider,
+            rate=getattr(Settings, f"{provider}_rate_limit", 0),
+            burst=getattr(Settings, f"{provider}_rate_burst", 1),
+            concurrency=getattr(Settings, f"{provider}_concurrency", 16),
+        )
+    return _limiters[provider]